@@ -15,23 +15,161 @@
 #License along with this library; if not, write to the Free Software
 #Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
-import yaml
 import os
+import json
 from os.path import splitext, exists, join
-# pylint: disable=W0622
-from codecs import open
+from copy import copy
+from multiprocessing import Pool
 
 from errors import *
-from common import BOLTSParameters, BOLTSNaming, parse_angled, check_schema
+from common import BOLTSParameters, BOLTSNaming, parse_angled, Schema
+from cache import CollectionCache, file_stamp
+from loader import parse_document, read_file
 
 CURRENT_VERSION = 0.3
 
+COLLECTION_SCHEMA = Schema("collection",
+	["id","author","license","blt-version","classes"],
+	["name","description"]
+)
+CLASS_SCHEMA = Schema("class",
+	["naming","source","id"],
+	["description","standard","status","replaces","parameters","url","notes"]
+)
+
+def _load_collection(path,filename,data,stamp,lazy=False,trusted=False,errors=None,documents=None):
+	#parse and build a single collection from the content of a blt file. If
+	#errors is a list, problems are collected there and None is returned
+	#for a collection that can not be used
+	collected = []
+	try:
+		if documents is None:
+			coll = parse_document(data,join(path,"data",filename))
+		else:
+			coll = documents.parse(data,join(path,"data",filename),stamp)
+		collection = BOLTSCollection(coll,lazy,None if errors is None else collected,trusted)
+
+		if not collection.id == splitext(filename)[0]:
+			raise MalformedCollectionError(
+				"Collection ID is not identical with file name: %s" % filename)
+
+		if collection.id in ["common","gui","template"]:
+			raise MalformedCollectionError(
+					"Forbidden collection id: %s" % collection.id)
+	except ParsingError as e:
+		if errors is None:
+			e.set_repo_path(path)
+			e.set_collection(filename)
+			raise e
+		collected.append(e)
+		collection = None
+	except (ValueError,KeyError) as e:
+		if errors is None:
+			raise
+		collected.append(UnexpectedError(e))
+		collection = None
+	if not errors is None:
+		for e in collected:
+			e.set_repo_path(path)
+			e.set_collection(filename)
+		errors.extend(collected)
+	return collection
+
+def _class_stamps(data,filename):
+	#class id to a stamp of the source of the class, for the content of a
+	#blt file that was loaded before
+	stamps = {}
+	for cl in parse_document(data,filename)["classes"]:
+		stamps[cl["id"]] = file_stamp(json.dumps(cl,sort_keys=True,default=repr))
+	return stamps
+
+def _build_collection(args):
+	#entry point for the worker processes
+	return _load_collection(*args)
+
+def _load_collections(path,tasks,processes,lazy,trusted=False,documents=None):
+	#build collections for a list of (filename,data,stamp), optionally in
+	#parallel. The worker processes do not share the documents
+	if processes is None or processes < 2 or len(tasks) < 2:
+		return [_load_collection(path,*(task + (lazy,trusted,None,documents))) for task in tasks]
+	pool = Pool(min(processes,len(tasks)))
+	try:
+		return pool.map(_build_collection,[(path,) + task + (lazy,trusted) for task in tasks])
+	finally:
+		pool.close()
+		pool.join()
+
+class RepositoryChanges:
+	"Collections and classes that were affected by loading or reloading a repository"
+	def __init__(self):
+		#collection ids
+		self.added_collections = []
+		self.changed_collections = []
+		self.removed_collections = []
+		#class ids
+		self.added_classes = set()
+		self.changed_classes = set()
+		self.removed_classes = set()
+		#class id to collection id, before and after
+		self._old = {}
+		self._new = {}
+		#class id to source stamp, before and after, for changed blt files
+		self._old_stamps = {}
+		self._new_stamps = {}
+
+	def _finish(self):
+		#a class that was removed and added again only counts as changed if
+		#its source or its collection differs
+		moved = self.added_classes & self.removed_classes
+		for id in moved:
+			if self._old[id] != self._new[id] or self._old_stamps.get(id) is None or \
+					self._old_stamps[id] != self._new_stamps.get(id):
+				self.changed_classes.add(id)
+		self.added_classes -= moved
+		self.removed_classes -= moved
+		self.changed_classes -= self.added_classes | self.removed_classes
+
+	def get_affected_classes(self):
+		return self.added_classes | self.changed_classes | self.removed_classes
+
+	def is_empty(self):
+		return len(self.get_affected_classes()) == 0 and \
+			len(self.added_collections + self.changed_collections + self.removed_collections) == 0
+
 class BOLTSRepository:
 	#order is important
 	standard_bodies = ["DINENISO","DINEN","DINISO","DIN","EN","ISO","ANSI","ASME"]
-	def __init__(self,path):
+	def __init__(self,path,cachefile=None,processes=None,lazy=False,trusted=False,documents=None):
 		self.path = path
+		self.cachefile = cachefile
+		self.processes = processes
+		self.lazy = lazy
+		#skip schema checks for blt files that are known to be valid
+		self.trusted = trusted
+		#optional DocumentCache, shared with databases
+		self.documents = documents
 		self.collections = []
+		self.standardized = dict((body,[]) for body in self.standard_bodies)
+		self.classids = set()
+
+		#indexes for lookups, kept up to date on reload
+		self._collections = {}
+		self._classes = {}
+		self._class_collection = {}
+		#name to list of classes with this name
+		self._names = {}
+
+		#blt file name to stamp and collection
+		self._files = {}
+		#blt file name to content, to find the changed classes on reload
+		self._data = {}
+		self._cache = None
+		#name of replaced class to name of replacing class
+		self._replacements = {}
+
+		#called with the RepositoryChanges after every reload
+		self._reload_hooks = []
+		self.collect_cache = None
 
 		#check for conformity
 		if not exists(path):
@@ -43,71 +181,264 @@ class BOLTSRepository:
 			e.set_repo_path(path)
 			raise e
 
-		#load collection data
-		for filename in os.listdir(join(path,"data")):
-			if splitext(filename)[1] == ".blt":
-
-				coll = list(yaml.load_all(open(join(path,"data",filename),"r","utf8")))
-				if len(coll) == 0:
-					raise MalformedCollectionError(
-							"No YAML document found in file %s" % filename)
-				if len(coll) > 1:
-					raise MalformedCollectionError(
-							"More than one YAML document found in file %s" % filename)
-
-				try:
-					self.collections.append(BOLTSCollection(coll[0]))
-				except ParsingError as e:
-					e.set_repo_path(path)
-					e.set_collection(filename)
-					raise e
-
-				if not self.collections[-1].id == splitext(filename)[0]:
-					raise MalformedCollectionError(
-						"Collection ID is not identical with file name: %s" % filename)
-
-				if self.collections[-1].id in ["common","gui","template"]:
-					raise MalformedCollectionError(
-							"Forbidden collection id: %s" % id)
-
-		self.standardized = dict((body,[]) for body in self.standard_bodies)
-
-		#find standard parts and their respective standard bodies
-		for coll in self.collections:
-			for cl in coll.classes:
-				#order is important
-				for body in self.standard_bodies:
-					if cl.name.startswith(body):
-						self.standardized[body].append(cl)
-						cl.standard_body = body
-						break
-
-		#fill in obsolescence data
+		self._update()
+
+	def reload(self):
+		"""
+		Picks up added, changed and removed blt files. Only the affected
+		collections are rebuilt, returns the RepositoryChanges.
+		"""
+		changes = self._update()
+		for hook in self._reload_hooks:
+			hook(changes)
+		return changes
+
+	def add_reload_hook(self,hook):
+		"Registers a function that is called with the RepositoryChanges of every reload"
+		self._reload_hooks.append(hook)
+
+	def set_collect_cache(self,cache):
+		"""
+		Memoizes collected parameters and names of all classes in a LRUCache.
+		Entries of classes affected by a reload are invalidated.
+		"""
+		if self.collect_cache is None:
+			self.add_reload_hook(self._invalidate_collect_cache)
+		self.collect_cache = cache
 		for coll in self.collections:
-			for cl in coll.classes:
-				if cl.replaces is None:
+			for cl in coll.classes_by_ids():
+				cl.set_cache(cache)
+
+	def _invalidate_collect_cache(self,changes):
+		if not self.collect_cache is None:
+			self.collect_cache.invalidate(changes.get_affected_classes())
+
+	def get_collection(self,collid):
+		return self._collections[collid]
+
+	def get_class_by_id(self,classid):
+		"Returns the class with the given id, for a class with several names the first one"
+		return self._classes[classid]
+
+	def get_class_by_name(self,name):
+		return self._names[name][0]
+
+	def get_classes_by_body(self,body):
+		return self.standardized[body]
+
+	def get_collection_of(self,classid):
+		"Returns the collection that contains the class with the given id"
+		return self._class_collection[classid]
+
+	def get_stamp(self,collid):
+		"Returns the content stamp of the blt file of a collection"
+		return self._files["%s.blt" % collid][0]
+
+	def validate(self):
+		"""
+		Builds everything that is deferred in lazy mode, raises on the first
+		problem like a non-lazy load would
+		"""
+		for filename, (stamp, coll) in self._files.iteritems():
+			try:
+				coll.validate()
+			except ParsingError as e:
+				e.set_repo_path(self.path)
+				e.set_collection(filename)
+				raise e
+
+	def _update(self):
+		changes = RepositoryChanges()
+
+		#collections whose blt file did not change are taken from the cache,
+		#which is only read from disk once
+		if self._cache is None and not self.cachefile is None:
+			self._cache = CollectionCache(self.cachefile,CURRENT_VERSION)
+		cache = self._cache
+
+		#load collection data, building is independent for each collection
+		filenames = []
+		stamps = {}
+		datas = {}
+		collections = {}
+		tasks = []
+		for filename in os.listdir(join(self.path,"data")):
+			if splitext(filename)[1] == ".blt":
+				data = read_file(join(self.path,"data",filename))
+				stamp = file_stamp(data)
+				filenames.append(filename)
+				stamps[filename] = stamp
+				datas[filename] = data
+
+				if filename in self._files and self._files[filename][0] == stamp:
+					if not cache is None and cache.get(filename,stamp) is None:
+						cache.put(filename,stamp,self._files[filename][1])
 					continue
-				#order in standard_bodies is important
-				for body in self.standard_bodies:
-					if cl.replaces.startswith(body):
-						idx = [c.name for c in self.standardized[body]].index(cl.replaces)
-						self.standardized[body][idx].replacedby = cl.name
-						break
-
-		#check for nonunique class ids
-		classids = []
-		for coll in self.collections:
+				if not cache is None:
+					collections[filename] = cache.get(filename,stamp)
+					#collections built without schema checks are only reused
+					#by trusted repositories
+					if not self.trusted and not collections[filename] is None and \
+							collections[filename].trusted:
+						collections[filename] = None
+				if collections.get(filename) is None:
+					tasks.append((filename,data,stamp))
+				elif not self.lazy:
+					#might have been stored by a lazy repository
+					try:
+						collections[filename].validate()
+					except ParsingError as e:
+						e.set_repo_path(self.path)
+						e.set_collection(filename)
+						raise e
+
+		built = _load_collections(self.path,tasks,self.processes,self.lazy,self.trusted,self.documents)
+		for task,coll in zip(tasks,built):
+			collections[task[0]] = coll
+			if not cache is None:
+				cache.put(task[0],task[2],coll)
+
+		#store before the collections get linked below
+		if not cache is None:
+			cache.save()
+
+		outgoing = [self._files[f][1] for f in self._files if not stamps.get(f) == self._files[f][0]]
+		incoming = [collections[f] for f in filenames if f in collections]
+
+		#check for nonunique class ids and missing replaced classes before
+		#anything is changed
+		classids = set(self.classids)
+		for coll in outgoing:
+			classids -= set(cl.id for cl in coll.classes)
+		for coll in incoming:
 			for cl in coll.classes_by_ids():
 				if cl.id in classids:
 					raise NonUniqueClassIdError(cl.id)
-				classids.append(cl.id)
+				classids.add(cl.id)
+
+		prospective = [collections.get(f) or self._files[f][1] for f in filenames]
+		standardized = set()
+		for coll in prospective:
+			for cl in coll.classes:
+				if self._get_body(cl.name) is not None:
+					standardized.add(cl.name)
+		for coll in prospective:
+			for cl in coll.classes:
+				if cl.replaces is None or self._get_body(cl.replaces) is None:
+					continue
+				if not cl.replaces in standardized:
+					raise ValueError("Replaced class not found: %s" % cl.replaces)
+
+		for coll in outgoing:
+			self._remove_collection(coll,changes)
+		for coll in incoming:
+			self._add_collection(coll,changes)
+			if not self.collect_cache is None:
+				for cl in coll.classes_by_ids():
+					cl.set_cache(self.collect_cache)
+
+		for filename in filenames:
+			if filename in collections:
+				if filename in self._files:
+					changes.changed_collections.append(collections[filename].id)
+					#only the classes of changed files are compared
+					changes._old_stamps.update(_class_stamps(self._data[filename],filename))
+					changes._new_stamps.update(_class_stamps(datas[filename],filename))
+				else:
+					changes.added_collections.append(collections[filename].id)
+				self._files[filename] = (stamps[filename],collections[filename])
+				self._data[filename] = datas[filename]
+		for filename in self._files.keys():
+			if not filename in stamps:
+				changes.removed_collections.append(self._files[filename][1].id)
+				del self._files[filename]
+				del self._data[filename]
+
+		self.collections = [self._files[filename][1] for filename in filenames]
+		changes._finish()
+
+		return changes
+
+	def _get_body(self,name):
+		#order is important
+		for body in self.standard_bodies:
+			if name.startswith(body):
+				return body
+		return None
+
+	def _find_standardized(self,name):
+		if not name in self._names:
+			return None
+		cl = self._names[name][0]
+		if cl.standard_body is None:
+			return None
+		return cl
+
+	def _add_collection(self,coll,changes):
+		self._collections[coll.id] = coll
+
+		#find standard parts and their respective standard bodies
+		for cl in coll.classes:
+			cl.replacedby = None
+			cl.standard_body = self._get_body(cl.name)
+			if not cl.standard_body is None:
+				self.standardized[cl.standard_body].append(cl)
+			self._names.setdefault(cl.name,[]).append(cl)
+
+		for cl in coll.classes_by_ids():
+			self.classids.add(cl.id)
+			self._classes[cl.id] = cl
+			self._class_collection[cl.id] = coll
+			changes.added_classes.add(cl.id)
+			changes._new[cl.id] = coll.id
+
+		#fill in obsolescence data, in both directions
+		for cl in coll.classes:
+			if cl.replaces is None or self._get_body(cl.replaces) is None:
+				continue
+			self._replacements[cl.replaces] = cl.name
+			replaced = self._find_standardized(cl.replaces)
+			if not replaced is None:
+				replaced.replacedby = cl.name
+				changes.changed_classes.add(replaced.id)
+		for cl in coll.classes:
+			if not cl.standard_body is None and cl.name in self._replacements:
+				cl.replacedby = self._replacements[cl.name]
+
+	def _remove_collection(self,coll,changes):
+		if self._collections.get(coll.id) is coll:
+			del self._collections[coll.id]
+
+		for cl in coll.classes:
+			if not cl.standard_body is None:
+				self.standardized[cl.standard_body].remove(cl)
+			self._names[cl.name].remove(cl)
+			if len(self._names[cl.name]) == 0:
+				del self._names[cl.name]
+
+		for cl in coll.classes_by_ids():
+			self.classids.discard(cl.id)
+			del self._classes[cl.id]
+			del self._class_collection[cl.id]
+			changes.removed_classes.add(cl.id)
+			changes._old[cl.id] = coll.id
+
+		for cl in coll.classes:
+			if cl.replaces is None or self._replacements.get(cl.replaces) != cl.name:
+				continue
+			del self._replacements[cl.replaces]
+			replaced = self._find_standardized(cl.replaces)
+			if not replaced is None and replaced.replacedby == cl.name:
+				replaced.replacedby = None
+				changes.changed_classes.add(replaced.id)
 
 class BOLTSCollection:
-	def __init__(self,coll):
-		check_schema(coll,"collection",
-			["id","author","license","blt-version","classes"],
-			["name","description"]
-		)
+	def __init__(self,coll,lazy=False,errors=None,trusted=False):
+		#if errors is a list, classes with problems are skipped and the
+		#problems collected there. Schema checks are skipped for trusted input
+		COLLECTION_SCHEMA.check(coll,trusted)
+		#whether schema checks were skipped
+		self.trusted = trusted
 
 		version = coll["blt-version"]
 		if version != CURRENT_VERSION:
@@ -144,46 +475,102 @@ class BOLTSCollection:
 			raise MalformedCollectionError("No class in collection %s"% self.id)
 
 		self.classes = []
-		classids = []
+		classids = set()
 		for cl in coll["classes"]:
+			if not "id" in cl:
+				if errors is None:
+					raise MissingFieldError("class","id")
+				errors.append(MissingFieldError("class","id"))
+				continue
 			names = cl["id"]
 			if cl["id"] in classids:
-				raise NonUniqueClassIdError(cl["id"])
-			classids.append(cl["id"])
+				if errors is None:
+					raise NonUniqueClassIdError(cl["id"])
+				errors.append(NonUniqueClassIdError(cl["id"]))
+				continue
+			classids.add(cl["id"])
 			if "standard" in cl:
 				names = cl["standard"]
 			if isinstance(names,str):
 				names = [names]
+			#all names of a class share the naming and parameters objects
+			first = None
 			for name in names:
 				try:
-					self.classes.append(BOLTSClass(cl,name))
+					if first is None:
+						first = BOLTSClass(cl,name,lazy,trusted)
+						self.classes.append(first)
+					else:
+						self.classes.append(first.renamed(name))
 				except ParsingError as e:
 					e.set_class(name)
-					raise
+					if errors is None:
+						raise
+					errors.append(e)
+					break
+				except (ValueError,KeyError) as e:
+					#malformed tables or fields, collect them like parsing errors
+					if errors is None:
+						raise
+					e = UnexpectedError(e)
+					e.set_class(name)
+					errors.append(e)
+					break
 
 	def classes_by_ids(self):
-		class_ids = []
+		class_ids = set()
 		for cl in self.classes:
 			if cl.id in class_ids:
 				continue
-			class_ids.append(cl.id)
+			class_ids.add(cl.id)
 			yield cl
 
+	def validate(self):
+		for cl in self.classes_by_ids():
+			cl.validate()
+
+class _LazyParameters:
+	#builds the BOLTSParameters of a class on first use
+	def __init__(self,param,classid,trusted=False):
+		self.param = param
+		self.classid = classid
+		self.trusted = trusted
+		self.parameters = None
+		self.cache = None
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state["cache"] = None
+		return state
+
+	def set_cache(self,cache):
+		self.cache = cache
+		if not self.parameters is None:
+			self.parameters.set_cache(cache,self.classid)
+
+	def get(self):
+		if self.parameters is None:
+			try:
+				self.parameters = BOLTSParameters(self.param,self.trusted)
+			except ParsingError as e:
+				e.set_class(self.classid)
+				raise e
+			self.param = None
+			if not self.cache is None:
+				self.parameters.set_cache(self.cache,self.classid)
+		return self.parameters
+
 #In contrast to the class-element specified in the blt, this structure has only
 #one name, a blt class element gets split into several BOLTSClasses during
 #parsing
 class BOLTSClass:
-	def __init__(self,cl,name):
-		check_schema(cl,"class",
-			["naming","source","id"],
-			["description","standard","status","replaces","parameters",
-				"url","notes"]
-		)
+	def __init__(self,cl,name,lazy=False,trusted=False):
+		CLASS_SCHEMA.check(cl,trusted)
 
 		self.id = cl["id"]
 
 		try:
-			self.naming = BOLTSNaming(cl["naming"])
+			self.naming = BOLTSNaming(cl["naming"],trusted)
 		except ParsingError as e:
 			e.set_class(self.id)
 			raise e
@@ -214,14 +601,10 @@ class BOLTSClass:
 		#gets updated later by the repo
 		self.replacedby = None
 
-		try:
-			if "parameters" in cl:
-				self.parameters = BOLTSParameters(cl["parameters"])
-			else:
-				self.parameters = BOLTSParameters({})
-		except ParsingError as e:
-			e.set_class(self.id)
-			raise e
+		#in lazy mode the parameters are built on first access
+		self._lazy_parameters = _LazyParameters(cl.get("parameters",{}),self.id,trusted)
+		if not lazy:
+			self.validate()
 
 		self.url = ""
 		if "url" in cl:
@@ -233,5 +616,32 @@ class BOLTSClass:
 
 		self.source = cl["source"]
 
+		self._set_name(name)
+
+	def _set_name(self,name):
 		self.name = name
 		self.openscadname = name.replace("-","_").replace(" ","_").replace(".","_")
+
+	def renamed(self,name):
+		"""
+		Returns a BOLTSClass for another name of the same class. Naming and
+		parameters are shared, so they must be treated as read-only.
+		"""
+		res = copy(self)
+		res._set_name(name)
+		return res
+
+	def __getattr__(self,name):
+		if name == "parameters":
+			self.parameters = self._lazy_parameters.get()
+			return self.parameters
+		raise AttributeError(name)
+
+	def validate(self):
+		"Builds the parameters if that was deferred, raises if they are malformed"
+		self.parameters = self._lazy_parameters.get()
+
+	def set_cache(self,cache):
+		"Memoizes collected parameters and names in a LRUCache, shared by all names"
+		self._lazy_parameters.set_cache(cache)
+		self.naming.set_cache(cache,self.id)
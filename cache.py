@@ -0,0 +1,178 @@
+#bolttools - a framework for creation of part libraries
+#Copyright (C) 2013 Johannes Reinhardt <jreinhardt@ist-dein-freund.de>
+#
+#This library is free software; you can redistribute it and/or
+#modify it under the terms of the GNU Lesser General Public
+#License as published by the Free Software Foundation; either
+#version 2.1 of the License, or any later version.
+#
+#This library is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#Lesser General Public License for more details.
+#
+#You should have received a copy of the GNU Lesser General Public
+#License along with this library; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+#caches for parsed and built data
+
+import os
+import hashlib
+import cPickle as pickle
+from os.path import exists, dirname, join, abspath
+from collections import OrderedDict
+
+#increase when the layout of cached objects changes
+CACHE_VERSION = 3
+
+def _code_stamp():
+	#stamp of the source of the modules that build the cached objects, so
+	#that changes to them invalidate the cache even without a version bump
+	stamp = hashlib.sha1()
+	root = dirname(abspath(__file__))
+	for filename in ["blt.py","common.py","cache.py"]:
+		try:
+			with open(join(root,filename),"rb") as fid:
+				stamp.update(fid.read())
+		except IOError:
+			#only compiled modules, rely on CACHE_VERSION
+			stamp.update(filename)
+	return stamp.hexdigest()
+
+CODE_STAMP = _code_stamp()
+
+def file_stamp(data):
+	"Returns a stamp identifying the content of a file"
+	return hashlib.sha1(data).hexdigest()
+
+class CollectionCache:
+	"""
+	On-disk cache of built collections, keyed by file name and content stamp.
+	Entries are only valid for the same cache and spec version and the same
+	source of bolttools.
+	"""
+	def __init__(self,filename,version):
+		self.filename = filename
+		self.version = (CACHE_VERSION,CODE_STAMP,version)
+		self.entries = {}
+		self.used = set()
+		self.dirty = False
+		self.hits = 0
+		self.misses = 0
+
+		if not exists(filename):
+			return
+		try:
+			with open(filename,"rb") as fid:
+				version, entries = pickle.load(fid)
+		except Exception:
+			#a broken cache is no reason to fail, it just gets rebuilt
+			self.dirty = True
+			return
+		if version == self.version:
+			self.entries = entries
+		else:
+			self.dirty = True
+
+	def get(self,key,stamp):
+		"Returns the cached object for key, or None if missing or outdated"
+		self.used.add(key)
+		if key in self.entries and self.entries[key][0] == stamp:
+			self.hits += 1
+			return self.entries[key][1]
+		self.misses += 1
+		return None
+
+	def put(self,key,stamp,value):
+		self.used.add(key)
+		self.entries[key] = (stamp,value)
+		self.dirty = True
+
+	def save(self):
+		"Writes the cache, dropping entries that were not used since the last save"
+		for key in self.entries.keys():
+			if not key in self.used:
+				del self.entries[key]
+				self.dirty = True
+		self.used = set()
+		if not self.dirty:
+			return
+		tmpname = "%s.%d.tmp" % (self.filename,os.getpid())
+		try:
+			if dirname(self.filename) and not exists(dirname(self.filename)):
+				os.makedirs(dirname(self.filename))
+			with open(tmpname,"wb") as fid:
+				pickle.dump((self.version,self.entries),fid,pickle.HIGHEST_PROTOCOL)
+			os.rename(tmpname,self.filename)
+		except (IOError,OSError):
+			#not being able to write the cache only costs time
+			if exists(tmpname):
+				os.remove(tmpname)
+			return
+		self.dirty = False
+
+def load_manifest(filename,version,default):
+	"Returns the manifest of an export stored with save_manifest, or default"
+	if not exists(filename):
+		return default
+	try:
+		with open(filename,"rb") as fid:
+			stored, manifest = pickle.load(fid)
+	except Exception:
+		return default
+	if stored != version:
+		return default
+	return manifest
+
+def save_manifest(filename,version,manifest):
+	tmpname = "%s.%d.tmp" % (filename,os.getpid())
+	with open(tmpname,"wb") as fid:
+		pickle.dump((version,manifest),fid,pickle.HIGHEST_PROTOCOL)
+	os.rename(tmpname,filename)
+
+class LRUCache:
+	"""
+	Bounded in-memory cache that evicts the least recently used entries.
+	Keys are tuples whose first element identifies the owner of the entry,
+	usually a class id, so that entries can be invalidated by owner.
+	"""
+	def __init__(self,maxsize=1024):
+		self.maxsize = maxsize
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def get(self,key,default=None):
+		if not key in self.entries:
+			self.misses += 1
+			return default
+		self.hits += 1
+		#move to the end, the most recently used position
+		value = self.entries.pop(key)
+		self.entries[key] = value
+		return value
+
+	def put(self,key,value):
+		if key in self.entries:
+			del self.entries[key]
+		elif len(self.entries) >= self.maxsize:
+			self.entries.popitem(last=False)
+			self.evictions += 1
+		self.entries[key] = value
+
+	def invalidate(self,owners):
+		"Drops all entries of the given owners"
+		owners = set(owners)
+		for key in [key for key in self.entries if key[0] in owners]:
+			del self.entries[key]
+
+	def clear(self):
+		self.entries.clear()
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __contains__(self,key):
+		return key in self.entries
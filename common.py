@@ -19,59 +19,276 @@
 
 import re
 from os.path import join
-from copy import deepcopy
+from array import array
+from itertools import product
+from operator import itemgetter
+from bisect import bisect_left, bisect_right
 
 from errors import *
+from cache import LRUCache
 
 RE_ANGLED = re.compile("([^<]*)<([^>]*)>")
 
+NAN = float("nan")
+
 def parse_angled(string):
 	match = RE_ANGLED.match(string)
 	if match is None:
 		raise MalformedStringError("Expected string containing <>")
 	return match.group(1).strip(), match.group(2).strip()
 
+class Schema:
+	"Mandatory and optional fields of an element, declared once per element type"
+	def __init__(self,element_name,mandatory_fields,optional_fields):
+		self.element_name = element_name
+		self.mandatory_fields = tuple(mandatory_fields)
+		self.fields = frozenset(mandatory_fields) | frozenset(optional_fields)
+
+	def check(self,yaml_dict,trusted=False):
+		#check dict from YAML parsing for correct and complete fields,
+		#skipped for trusted input that is known to be valid
+		if trusted:
+			return
+		fields = self.fields
+		for key in yaml_dict:
+			if not key in fields:
+				raise UnknownFieldError(self.element_name,key)
+		for field in self.mandatory_fields:
+			if not field in yaml_dict:
+				missing = [f for f in self.mandatory_fields if not f in yaml_dict]
+				raise MissingFieldError(self.element_name,missing)
+
 def check_schema(yaml_dict, element_name, mandatory_fields, optional_fields):
-	#check dict from YAML parsing for correct and complete fields
-	for key in yaml_dict.keys():
-		if key in mandatory_fields:
-			mandatory_fields.remove(key)
-		elif key in optional_fields:
-			optional_fields.remove(key)
-		else:
-			raise UnknownFieldError(element_name,key)
-	if len(mandatory_fields) > 0:
-		raise MissingFieldError(element_name,mandatory_fields)
-
-class Sorting:
-	def __init__(self):
-		pass
-	def is_applicable(self,choices):
-		return False
-	def sort(self,choices):
-		return choices
-
-class Numerical(Sorting):
-	def __init__(self):
-		Sorting.__init__(self)
-		self.re = re.compile("[^0-9]*([0-9]+\.*[0-9]*)[^0-9]*$")
-	def is_applicable(self,choices):
-		for choice in choices:
-			if self.re.match(choice) is None:
-				return False
+	Schema(element_name,mandatory_fields,optional_fields).check(yaml_dict)
+
+#numbers in choices: mixed numbers like 1-1/2, fractions like 3/8 and decimals
+RE_NUMBER = re.compile("([0-9]+)-([0-9]+)/([0-9]+)|([0-9]+)/([0-9]+)|([0-9]+(?:\.[0-9]+)?)")
+
+#sort keys of recently used values, bounded for long running processes
+NATURAL_KEYS = LRUCache(4096)
+
+def natural_key(value):
+	"""
+	Returns a sort key that orders numbers within a value numerically, so
+	that M2 < M10, M10x1 < M10x1.25 and 1/4-20 < 3/8-16 < 1-1/2-6
+	"""
+	key = NATURAL_KEYS.get(value)
+	if not key is None:
+		return key
+	if isinstance(value,(int,long,float)):
+		parts = ((0,float(value)),)
+	else:
+		string = value if isinstance(value,basestring) else str(value)
+		parts = []
+		pos = 0
+		for match in RE_NUMBER.finditer(string):
+			text = "".join(string[pos:match.start()].lower().split())
+			if text:
+				parts.append((1,text))
+			mixed, num, den = match.group(1,2,3)
+			if not mixed is None:
+				number = int(mixed) + float(num)/float(den)
+			elif not match.group(4) is None:
+				number = float(match.group(4))/float(match.group(5))
+			else:
+				number = float(match.group(6))
+			parts.append((0,number))
+			pos = match.end()
+		text = "".join(string[pos:].lower().split())
+		if text:
+			parts.append((1,text))
+		parts = tuple(parts)
+	#the value itself decides between equivalent spellings
+	key = (parts,value)
+	NATURAL_KEYS.put(value,key)
+	return key
+
+def sort_choices(choices):
+	"Returns the choices as a list in natural order"
+	return sorted(choices,key=natural_key)
+
+PARAMETERS_SCHEMA = Schema("parameters",
+	[],
+	["literal","free","tables","tables2d","types","defaults","common","description"]
+)
+TABLE_SCHEMA = Schema("table",["index","columns","data"],[])
+TABLE2D_SCHEMA = Schema("table2d",["rowindex","colindex","columns","result","data"],[])
+NAMING_SCHEMA = Schema("naming",["template"],["substitute"])
+
+class CommonCombinations:
+	"""
+	Sequence of common combinations of free parameter values. It is the
+	concatenation of cartesian products of the values allowed for each free
+	parameter, combinations are only generated when they are accessed.
+	"""
+	def __init__(self,products):
+		#list of products, each a list with the values for every free parameter
+		self.products = products
+		self.sizes = []
+		for factors in products:
+			size = 1
+			for values in factors:
+				size *= len(values)
+			self.sizes.append(size)
+		self.length = sum(self.sizes)
+		#value to position for every factor, built when needed
+		self._positions = None
+
+	def __len__(self):
+		return self.length
+
+	def __iter__(self):
+		for factors in self.products:
+			for combination in product(*factors):
+				yield list(combination)
+
+	def __getitem__(self,idx):
+		#like the list it replaces
+		if isinstance(idx,slice):
+			return [self[i] for i in xrange(*idx.indices(self.length))]
+		if not isinstance(idx,(int,long)):
+			raise TypeError("Common combination indices must be integers")
+		if idx < 0:
+			idx += self.length
+		if idx < 0 or idx >= self.length:
+			raise IndexError("Common combination index out of range")
+		for factors,size in zip(self.products,self.sizes):
+			if idx < size:
+				#mixed radix, the last parameter varies fastest
+				combination = []
+				for values in reversed(factors):
+					idx, pos = divmod(idx,len(values))
+					combination.append(values[pos])
+				combination.reverse()
+				return combination
+			idx -= size
+
+	def index(self,combination):
+		"Returns the position of the first occurence of combination"
+		if self._positions is None:
+			self._positions = []
+			for factors in self.products:
+				positions = []
+				for values in factors:
+					pos = {}
+					for i,value in enumerate(values):
+						pos.setdefault(value,i)
+					positions.append(pos)
+				self._positions.append(positions)
+		offset = 0
+		for factors,positions,size in zip(self.products,self._positions,self.sizes):
+			if len(combination) == len(factors):
+				idx = 0
+				for value,values,pos in zip(combination,factors,positions):
+					if not value in pos:
+						break
+					idx = idx*len(values) + pos[value]
+				else:
+					return offset + idx
+			offset += size
+		raise ValueError("Not a common combination: %s" % combination)
+
+	def __contains__(self,combination):
+		try:
+			self.index(combination)
+		except ValueError:
+			return False
 		return True
-	def sort(self,choices):
-		return sorted(choices, key=lambda x: float(self.re.match(x).group(1)))
 
-class Alphabetical(Sorting):
-	def __init__(self):
-		Sorting.__init__(self)
-	def is_applicable(self,choices):
-		return True
-	def sort(self,choices):
-		return sorted(choices)
+class ParameterRecord(object):
+	"Immutable collected parameter values, accessible like a read-only dict"
+	__slots__ = ("_values",)
+	def __init__(self,values):
+		#never handed out, so it can not be modified
+		self._values = values
+
+	def __getitem__(self,pname):
+		return self._values[pname]
+
+	def __contains__(self,pname):
+		return pname in self._values
+
+	def __iter__(self):
+		return iter(self._values)
+
+	def __len__(self):
+		return len(self._values)
+
+	def __eq__(self,other):
+		if isinstance(other,ParameterRecord):
+			return self._values == other._values
+		return self._values == other
+
+	def __ne__(self,other):
+		return not self == other
+
+	def get(self,pname,default=None):
+		return self._values.get(pname,default)
+
+	def keys(self):
+		return self._values.keys()
+
+	def items(self):
+		return self._values.items()
+
+	def as_dict(self):
+		return dict(self._values)
+
+	def __repr__(self):
+		return "ParameterRecord(%r)" % self._values
+
+def _gather(values,indices):
+	#the items of values at indices as a list, itemgetter loops in C
+	if len(indices) == 1:
+		return [values[indices[0]]]
+	return list(itemgetter(*indices)(values))
+
+class CollectPlan:
+	"""
+	The steps to collect the values of all parameters, precomputed from a
+	BOLTSParameters. The columns of the tables are resolved once, so that
+	collecting reads values from the column storage by row position.
+	"""
+	def __init__(self,params):
+		produced = set(params.literal.keys())
+		for table in params.tables:
+			produced.update(table.columns)
+		for table in params.tables2d:
+			produced.add(table.result)
+
+		self.literal = dict(params.literal)
+		#index, row positions and (parameter name, column, nulls) per column
+		self.tables = [(table.index,table.data.positions,
+			zip(table.columns,table.data.columns,table.data.nulls))
+			for table in params.tables]
+		#indices, result, row positions and column and nulls by column name
+		self.tables2d = [(table.rowindex,table.colindex,table.result,table.data.positions,
+			dict(zip(table.columns,zip(table.data.columns,table.data.nulls))))
+			for table in params.tables2d]
+
+		#only values that are neither literal nor looked up can be missing
+		self.required = [pname for pname in params.parameters if not pname in produced]
 
-SORTINGS = [Numerical(), Alphabetical()]
+	def collect(self,free):
+		res = dict(self.literal)
+		res.update(free)
+		for index,positions,columns in self.tables:
+			pos = positions[res[index]]
+			for pname,column,nulls in columns:
+				res[pname] = None if pos in nulls else column[pos]
+		for rowindex,colindex,result,positions,columns in self.tables2d:
+			pos = positions[res[rowindex]]
+			if not res[colindex] in columns:
+				raise ValueError("%s is not a column of the table" % res[colindex])
+			column, nulls = columns[res[colindex]]
+			res[result] = None if pos in nulls else column[pos]
+		for pname in self.required:
+			if not pname in res:
+				raise KeyError("Parameter value not collected: %s" % pname)
+		return res
+
+	def collect_record(self,free):
+		return ParameterRecord(self.collect(free))
 
 class BOLTSParameters:
 	type_defaults = {
@@ -82,11 +299,8 @@ class BOLTSParameters:
 		"Table Index": '',
 		"String" : ''
 	}
-	def __init__(self,param):
-		check_schema(param,"parameters",
-			[],
-			["literal","free","tables","tables2d","types","defaults","common","description"]
-		)
+	def __init__(self,param,trusted=False):
+		PARAMETERS_SCHEMA.check(param,trusted)
 
 		self.literal = {}
 		if "literal" in param:
@@ -100,26 +314,35 @@ class BOLTSParameters:
 		if "tables" in param:
 			if isinstance(param["tables"],list):
 				for table in param["tables"]:
-					self.tables.append(BOLTSTable(table))
+					self.tables.append(BOLTSTable(table,trusted))
 			else:
-				self.tables.append(BOLTSTable(param["tables"]))
+				self.tables.append(BOLTSTable(param["tables"],trusted))
 
 		self.tables2d = []
 		if "tables2d" in param:
 			if isinstance(param["tables2d"],list):
 				for table in param["tables2d"]:
-					self.tables2d.append(BOLTSTable2D(table))
+					self.tables2d.append(BOLTSTable2D(table,trusted))
 			else:
-				self.tables2d.append(BOLTSTable2D(param["tables2d"]))
+				self.tables2d.append(BOLTSTable2D(param["tables2d"],trusted))
 
+		#gets filled in below, so copy to leave the parsed document untouched
 		self.types = {}
 		if "types" in param:
-			self.types = param["types"]
+			self.types = dict(param["types"])
 
 		self.description = {}
 		if "description" in param:
 			self.description = param["description"]
 
+		#compiled on first collection
+		self._plan = None
+		#positions of choices for lookups
+		self._positions = {}
+		#optional LRUCache for collected values, see set_cache
+		self._cache = None
+		self._cache_owner = None
+
 		self.parameters = []
 		self.parameters += self.literal.keys()
 		self.parameters += self.free
@@ -187,12 +410,8 @@ class BOLTSParameters:
 						self.choices[pname] = set(table.columns)
 					else:
 						self.choices[pname] &= set(table.columns)
-		#figure out what the best way is to sort them
 		for pname in self.choices:
-			for sort in SORTINGS:
-				if sort.is_applicable(self.choices[pname]):
-					self.choices[pname] = sort.sort(self.choices[pname])
-					break
+			self.choices[pname] = sort_choices(self.choices[pname])
 
 		#default values for free parameters
 		self.defaults = dict((pname,self.type_defaults[self.types[pname]])
@@ -207,9 +426,8 @@ class BOLTSParameters:
 		discrete_types = ["Bool", "Table Index"]
 		self.common = None
 		if "common" in param:
-			self.common = []
-			for tup in param["common"]:
-				self._populate_common(tup,[],0)
+			self.common = CommonCombinations(
+				[self._common_factors(tup) for tup in param["common"]])
 		else:
 			discrete = True
 			for pname in self.free:
@@ -217,186 +435,486 @@ class BOLTSParameters:
 					discrete = False
 					break
 			if discrete:
-				self.common = []
-				if len(self.free) > 0:
-					self._populate_common([":" for _i in range(len(self.free))],[],0)
-				else:
-					self.common.append([])
-
-	def _populate_common(self, tup, values, idx):
-		if idx == len(self.free):
-			self.common.append(values)
-		else:
+				self.common = CommonCombinations(
+					[self._common_factors([":" for _i in range(len(self.free))])])
+
+	def _common_factors(self, tup):
+		#the values of each free parameter for a tuple from common
+		factors = []
+		for idx in range(len(self.free)):
+			pname = self.free[idx]
 			if tup[idx] == ":":
-				if self.types[self.free[idx]] == "Bool":
-					for v in [True, False]:
-						self._populate_common(tup,values + [v], idx+1)
-				elif self.types[self.free[idx]] == "Table Index":
-					#populate
-					for v in self.choices[self.free[idx]]:
-						self._populate_common(tup,values + [v], idx+1)
+				if self.types[pname] == "Bool":
+					factors.append([True, False])
+				elif self.types[pname] == "Table Index":
+					factors.append(self.choices[pname])
 				else:
-					print "That should not happen"
+					raise ValueError("Parameter %s of type %s can not be varied in common" %
+						(pname,self.types[pname]))
 			else:
-				for v in tup[idx]:
-					self._populate_common(tup,values + [v], idx+1)
+				factors.append(list(tup[idx]))
+		return factors
+
+	def get_plan(self):
+		"Returns the CollectPlan, which is compiled on first use"
+		if self._plan is None:
+			self._plan = CollectPlan(self)
+		return self._plan
+
+	def __getstate__(self):
+		#the plan is cheap to recompile, caches are not worth storing
+		state = self.__dict__.copy()
+		state["_plan"] = None
+		state["_cache"] = None
+		state["_positions"] = {}
+		return state
+
+	def set_cache(self,cache,owner):
+		"""
+		Memoizes results of collect in a LRUCache, under keys starting with
+		owner. Pass None as cache to stop memoizing.
+		"""
+		self._cache = cache
+		self._cache_owner = owner
+
+	def _cache_key(self,free):
+		#values are passed through unchanged, so the key includes their types
+		#to keep e.g. 37 and 37.0 apart. None for unhashable values
+		items = tuple(sorted((pname,type(value),value) for pname,value in free.iteritems()))
+		key = (self._cache_owner,"collect",items)
+		try:
+			hash(key)
+		except TypeError:
+			return None
+		return key
 
 	def collect(self,free):
-		res = {}
-		res.update(self.literal)
-		res.update(free)
+		if self._cache is None:
+			return self.get_plan().collect(free)
+		return self.collect_record(free).as_dict()
+
+	def collect_record(self,free):
+		"Like collect, but returns an immutable ParameterRecord"
+		if self._cache is None:
+			return self.get_plan().collect_record(free)
+		key = self._cache_key(free)
+		if key is None:
+			return self.get_plan().collect_record(free)
+		res = self._cache.get(key)
+		if res is None:
+			res = self.get_plan().collect_record(free)
+			self._cache.put(key,res)
+		return res
+
+	def _get_sorted(self,pname):
+		#find the table and sorted values for a parameter
 		for table in self.tables:
-			res.update(dict(zip(table.columns,table.data[res[table.index]])))
-		for table in self.tables2d:
-			row = table.data[res[table.rowindex]]
-			res[table.result] = row[table.columns.index(res[table.colindex])]
+			if pname in table.columns:
+				values, keys = table.get_sorted(pname)
+				return table, values, keys
+		raise KeyError("Parameter is not a table column: %s" % pname)
+
+	def _choice_positions(self,index):
+		#position in choices for all valid values of index, None if unrestricted
+		if not index in self.choices:
+			return None
+		if self._positions.get(index) is None:
+			self._positions[index] = dict((key,i) for i,key in enumerate(self.choices[index]))
+		return self._positions[index]
+
+	def _best_key(self,candidates,keys,values,positions):
+		#the key with the first value in candidates, ties are resolved by choice order
+		best = None
+		for i in candidates:
+			if not positions is None and not keys[i] in positions:
+				continue
+			if not best is None and values[i] != values[best]:
+				break
+			if best is None or (not positions is None and positions[keys[i]] < positions[keys[best]]):
+				best = i
+		return best
+
+	def lookup_ceiling(self,pname,value):
+		"Returns the key of the row with the smallest value of pname that is at least value"
+		table, values, keys = self._get_sorted(pname)
+		positions = self._choice_positions(table.index)
+		best = self._best_key(xrange(bisect_left(values,value),len(values)),keys,values,positions)
+		if best is None:
+			return None
+		return keys[best]
+
+	def lookup_floor(self,pname,value):
+		"Returns the key of the row with the largest value of pname that is at most value"
+		table, values, keys = self._get_sorted(pname)
+		positions = self._choice_positions(table.index)
+		best = self._best_key(xrange(bisect_right(values,value)-1,-1,-1),keys,values,positions)
+		if best is None:
+			return None
+		return keys[best]
+
+	def lookup_nearest(self,pname,value):
+		"Returns the key of the row with the value of pname that is closest to value"
+		floor = self.lookup_floor(pname,value)
+		ceiling = self.lookup_ceiling(pname,value)
+		if floor is None:
+			return ceiling
+		if ceiling is None:
+			return floor
+		table = self._get_sorted(pname)[0]
+		col = table.columns.index(pname)
+		if value - table.data.get_value(floor,col) <= table.data.get_value(ceiling,col) - value:
+			return floor
+		return ceiling
+
+	def lookup_range(self,pname,low=None,high=None):
+		"""
+		Returns the keys of all rows with low <= pname <= high, ordered like
+		the choices. low and high can be None for an open range.
+		"""
+		table, values, keys = self._get_sorted(pname)
+		positions = self._choice_positions(table.index)
+		start = 0 if low is None else bisect_left(values,low)
+		stop = len(values) if high is None else bisect_right(values,high)
+		res = keys[start:stop]
+		if positions is None:
+			return res
+		res = [key for key in res if key in positions]
+		res.sort(key=positions.__getitem__)
+		return res
+
+	def collect_many(self,free):
+		"""
+		Collects the parameter values for many assignments of the free
+		parameters at once. free is either a list of dicts or a dict of
+		equally long lists. Returns a dict with a list of values for each
+		parameter.
+		"""
+		if isinstance(free,dict):
+			columns = dict((pname,list(values)) for pname,values in free.iteritems())
+		else:
+			#converted to columns once, with the names of the first dict
+			free = list(free)
+			pnames = free[0].keys() if len(free) > 0 else []
+			columns = dict((pname,[values[pname] for values in free]) for pname in pnames)
+
+		lengths = set(len(values) for values in columns.values())
+		if len(lengths) > 1:
+			raise ValueError("Different number of values for free parameters")
+		n = lengths.pop() if len(lengths) == 1 else len(free)
+		if n == 0:
+			return dict((pname,[]) for pname in self.parameters)
+
+		res = {}
+		for pname,value in self.literal.iteritems():
+			res[pname] = [value]*n
+		res.update(columns)
+
+		#every row is only read once, the values are then gathered per column
+		plan = self.get_plan()
+		for index,positions,columns in plan.tables:
+			keys = res[index]
+			rows = dict((key,positions[key]) for key in set(keys))
+			for pname,column,nulls in columns:
+				values = dict((key,None if pos in nulls else column[pos])
+					for key,pos in rows.iteritems())
+				res[pname] = _gather(values,keys)
+		for rowindex,colindex,result,positions,columns in plan.tables2d:
+			keys = zip(res[rowindex],res[colindex])
+			values = {}
+			for key,col in set(keys):
+				if not col in columns:
+					raise ValueError("%s is not a column of the table" % col)
+				column, nulls = columns[col]
+				pos = positions[key]
+				values[key,col] = None if pos in nulls else column[pos]
+			res[result] = _gather(values,keys)
+
 		for pname in self.parameters:
 			if not pname in res:
 				raise KeyError("Parameter value not collected: %s" % pname)
 		return res
 
 	def union(self,other):
-		res = BOLTSParameters({})
-		res.literal.update(self.literal)
-		res.literal.update(other.literal)
-		res.free = self.free + other.free
-		res.tables = self.tables + other.tables
-		res.tables2d = self.tables2d + other.tables2d
-		res.parameters = list(set(self.parameters))
-
-		for pname,tname in self.types.iteritems():
-			res.types[pname] = tname
-		for pname,tname in other.types.iteritems():
-			if pname in res.types and self.types[pname] != tname:
-				raise IncompatibleTypeError(pname,self.types[pname],tname)
+		return union_parameters(self,other)
+
+def union_parameters(*params):
+	"""
+	Merges any number of BOLTSParameters into a new one, the choices of a
+	parameter are those allowed by all of them
+	"""
+	res = BOLTSParameters({})
+	parameters = set()
+	free = set()
+	choices = {}
+	for param in params:
+		res.literal.update(param.literal)
+		for pname in param.free:
+			if not pname in free:
+				free.add(pname)
+				res.free.append(pname)
+		res.tables += param.tables
+		res.tables2d += param.tables2d
+		parameters.update(param.parameters)
+
+		for pname,tname in param.types.iteritems():
+			if pname in res.types and res.types[pname] != tname:
+				raise IncompatibleTypeError(pname,res.types[pname],tname)
 			res.types[pname] = tname
 
-		for pname,dname in self.defaults.iteritems():
-			res.defaults[pname] = dname
-		for pname,dname in other.defaults.iteritems():
-			if pname in res.defaults and self.defaults[pname] != dname:
-				raise IncompatibleDefaultError(pname,self.defaults[pname],dname)
+		for pname,dname in param.defaults.iteritems():
+			if pname in res.defaults and res.defaults[pname] != dname:
+				raise IncompatibleDefaultError(pname,res.defaults[pname],dname)
 			res.defaults[pname] = dname
 
-		for pname,descr in self.description.iteritems():
-			res.description[pname] = descr
-		for pname,descr in other.description.iteritems():
-			if pname in res.description and self.description[pname] != descr:
-				raise IncompatibleDescriptionError(pname,self.description[pname],descr)
+		for pname,descr in param.description.iteritems():
+			if pname in res.description and res.description[pname] != descr:
+				raise IncompatibleDescriptionError(pname,res.description[pname],descr)
 			res.description[pname] = descr
 
-		res.choices = {}
-		for pname in self.choices:
-			res.choices[pname] = set(self.choices[pname])
-		for pname in other.choices:
-			if pname in res.choices:
-				res.choices[pname] &= set(other.choices[pname])
-			else:
-				res.choices[pname] = set(other.choices[pname])
-		sortings = [Numerical(), Alphabetical()]
-		for pname in res.choices:
-			for sort in SORTINGS:
-				if sort.is_applicable(res.choices[pname]):
-					res.choices[pname] = sort.sort(res.choices[pname])
-					break
-		return res
+		for pname,values in param.choices.iteritems():
+			choices.setdefault(pname,[]).append(values)
+	res.parameters = list(parameters)
+
+	res.choices = {}
+	for pname,lists in choices.iteritems():
+		#choices are sorted already, filtering the shortest keeps the order
+		lists.sort(key=len)
+		if len(lists) == 1:
+			res.choices[pname] = list(lists[0])
+		else:
+			others = [set(values) for values in lists[1:]]
+			res.choices[pname] = [value for value in lists[0]
+				if all(value in other for other in others)]
+	return res
+
+def _normalize_column(values,tname):
+	#convert the values of a table column, returns storage and positions of None
+	numbers = ["Length (mm)", "Length (in)", "Number"]
+	positive = ["Length (mm)", "Length (in)"]
+	rest = ["Bool", "Table Index", "String"]
+
+	nulls = frozenset(i for i,value in enumerate(values) if value == "None")
+	if tname in numbers:
+		if len(nulls) > 0:
+			values = [NAN if i in nulls else value for i,value in enumerate(values)]
+		column = array("d",[float(value) for value in values])
+		if tname in positive:
+			#NaN compares false, so None values do not count
+			negative = [value for value in column if value < 0]
+			if len(negative) > 0:
+				raise ValueError("Negative length in table: %f" % negative[0])
+		return column, nulls
+	elif not tname in rest:
+		raise ValueError("Unknown Type in table: %s" % tname)
+
+	column = [None if i in nulls else value for i,value in enumerate(values)]
+	if tname == "Bool":
+		for value in column:
+			if not value in ["True","False",None]:
+				raise ValueError("Unknown value for bool parameter: %s" % value)
+		column = [None if value is None else value == "True" for value in column]
+	return column, frozenset()
+
+class TableRows:
+	"""
+	Read-only mapping from index value to the row of a table. The values are
+	stored per column, numerical columns as arrays of doubles with the
+	positions of None values kept separately.
+	"""
+	def __init__(self,data,columns,col_types):
+		for key in data:
+			if len(data[key]) != len(columns):
+				raise ValueError("Column is missing for row: %s" % key)
+
+		#index values in row order
+		self.index = list(data.keys())
+		self.positions = dict((key,i) for i,key in enumerate(self.index))
+		self.columns = []
+		self.nulls = []
+		rows = [data[key] for key in self.index]
+		for i,tname in enumerate(col_types):
+			column, nulls = _normalize_column([row[i] for row in rows],tname)
+			self.columns.append(column)
+			self.nulls.append(nulls)
+
+		#sorted values and index values by column, built when needed
+		self._sorted = {}
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state["_sorted"] = {}
+		return state
+
+	def get_sorted(self,i):
+		"""
+		Returns the values of numerical column i in ascending order and the
+		index values of the corresponding rows. Rows with None are left out.
+		"""
+		if not i in self._sorted:
+			column = self.columns[i]
+			if not isinstance(column,array):
+				raise ValueError("Column is not numerical")
+			nulls = self.nulls[i]
+			pairs = sorted((column[pos],pos) for pos in xrange(len(column)) if not pos in nulls)
+			self._sorted[i] = ([value for value,pos in pairs],
+				[self.index[pos] for value,pos in pairs])
+		return self._sorted[i]
+
+	def get_value(self,key,i):
+		"Returns the value in column i of the row for key"
+		pos = self.positions[key]
+		if pos in self.nulls[i]:
+			return None
+		return self.columns[i][pos]
+
+	def __getitem__(self,key):
+		pos = self.positions[key]
+		return [None if pos in nulls else column[pos]
+			for column,nulls in zip(self.columns,self.nulls)]
+
+	def __contains__(self,key):
+		return key in self.positions
+
+	def __iter__(self):
+		return iter(self.index)
+
+	def __len__(self):
+		return len(self.index)
+
+	def get(self,key,default=None):
+		if not key in self.positions:
+			return default
+		return self[key]
+
+	def keys(self):
+		return list(self.index)
+
+	def iterkeys(self):
+		return iter(self.index)
+
+	def values(self):
+		return [self[key] for key in self.index]
+
+	def items(self):
+		return [(key,self[key]) for key in self.index]
+
+	def iteritems(self):
+		for key in self.index:
+			yield key, self[key]
 
 class BOLTSTable:
-	def __init__(self,table):
-		check_schema(table,"table",
-			["index","columns","data"],
-			[]
-		)
+	def __init__(self,table,trusted=False):
+		TABLE_SCHEMA.check(table,trusted)
 
 		self.index = table["index"]
 		self.columns = table["columns"]
-		self.data = deepcopy(table["data"])
+		#the parsed data, replaced by a TableRows during normalization
+		self.data = table["data"]
 
 	def _normalize_and_check_types(self,types):
-		numbers = ["Length (mm)", "Length (in)", "Number"]
-		positive = ["Length (mm)", "Length (in)"]
-		rest = ["Bool", "Table Index", "String"]
-		col_types = [types[col] for col in self.columns]
-		idx = range(len(self.columns))
-		for key in self.data:
-			row = self.data[key]
-			if len(row) != len(self.columns):
-				raise ValueError("Column is missing for row: %s" % key)
-			for i,tname in zip(idx,col_types):
-				if row[i] == "None":
-					row[i] = None
-				else:
-					if tname in numbers:
-						row[i] = float(row[i])
-					elif not tname in rest:
-						raise ValueError("Unknown Type in table: %s" % tname)
-					if tname in positive and row[i] < 0:
-						raise ValueError("Negative length in table: %f" % row[i])
-					if tname == "Bool":
-						if not row[i] in ["True","False"]:
-							raise ValueError("Unknown value for bool parameter: %s" % row[i])
-						row[i] = bool(row[i])
+		self.data = TableRows(self.data,self.columns,[types[col] for col in self.columns])
+
+	def get_sorted(self,column):
+		"Returns values of a numerical column in ascending order and the keys of their rows"
+		return self.data.get_sorted(self.columns.index(column))
 
 class BOLTSTable2D:
-	def __init__(self,table):
-		check_schema(table,"table2d",
-			["rowindex","colindex","columns","result","data"],
-			[]
-		)
+	def __init__(self,table,trusted=False):
+		TABLE2D_SCHEMA.check(table,trusted)
 
 		self.rowindex = table["rowindex"]
 		self.colindex = table["colindex"]
 		self.result = table["result"]
 		self.columns = table["columns"]
-		self.data = deepcopy(table["data"])
+		#the parsed data, replaced by a TableRows during normalization
+		self.data = table["data"]
 
 		if self.rowindex == self.colindex:
 			raise ValueError("Row- and ColIndex are identical. In this case a ordinary table should be used.")
 
 	def _normalize_and_check_types(self,types):
-		numbers = ["Length (mm)", "Length (in)", "Number"]
-		positive = ["Length (mm)", "Length (in)"]
-		rest = ["Bool", "Table Index", "String"]
 		res_type = types[self.result]
-		for key in self.data:
-			row = self.data[key]
-			if len(row) != len(self.columns):
-				raise ValueError("Column is missing for row: %s" % key)
-			for i in range(len(self.columns)):
-				if row[i] == "None":
-					row[i] = None
-				else:
-					if res_type in numbers:
-						row[i] = float(row[i])
-					elif not res_type in rest:
-						raise ValueError("Unknown Type in table: %s" % res_type)
-					if res_type in positive and row[i] < 0:
-						raise ValueError("Negative length in table: %f" % row[i])
-					if res_type == "Bool":
-						if not row[i] in ["True","False"]:
-							raise ValueError("Unknown value for bool parameter: %s" % row[i])
-						row[i] = bool(row[i])
+		self.data = TableRows(self.data,self.columns,[res_type for _col in self.columns])
 
 class BOLTSNaming:
-	def __init__(self,name):
-		check_schema(name,"naming",
-			["template"],
-			["substitute"]
-		)
+	def __init__(self,name,trusted=False):
+		NAMING_SCHEMA.check(name,trusted)
 
 		self.template = name["template"]
 		self.substitute = []
 		if "substitute" in name:
 			self.substitute = name["substitute"]
 
+		#optional LRUCache for names, see set_cache
+		self._cache = None
+		self._cache_owner = None
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state["_cache"] = None
+		return state
+
+	def set_cache(self,cache,owner):
+		"Memoizes names in a LRUCache, under keys starting with owner"
+		self._cache = cache
+		self._cache_owner = owner
+
 	def get_name(self,params):
-		return self.template % tuple(params[s] for s in self.substitute)
+		values = tuple(params[s] for s in self.substitute)
+		if self._cache is None:
+			return self.template % values
+		key = (self._cache_owner,"name",tuple((type(v),v) for v in values))
+		try:
+			hash(key)
+		except TypeError:
+			return self.template % values
+		name = self._cache.get(key)
+		if name is None:
+			name = self.template % values
+			self._cache.put(key,name)
+		return name
 
 
 class DataBase:
-	def __init__(self,name,path):
+	def __init__(self,name,path,errors=None,documents=None):
 		self.repo_root = path
 		self.backend_root = join(path,name)
+		#if a list is given, problems are collected there instead of raised
+		self.errors = errors
+		#optional DocumentCache for the base files
+		self.documents = documents
+		#class id to parameters of class and base and their union
+		self._unions = {}
+
+	def get_parameters(self,cl):
+		"""
+		Returns the union of the parameters of a class and its base, for
+		backends whose bases have parameters. The union is memoized as long
+		as class and base stay the same.
+		"""
+		base = self.getbase[cl.id]
+		entry = self._unions.get(cl.id)
+		if not entry is None and entry[0] is cl.parameters and entry[1] is base.parameters:
+			return entry[2]
+		res = union_parameters(cl.parameters,base.parameters)
+		self._unions[cl.id] = (cl.parameters,base.parameters,res)
+		return res
+
+	def _report(self,e):
+		if self.errors is None:
+			raise e
+		self.errors.append(e)
+
+	def _report_unexpected(self,error,coll,element):
+		#for a ValueError or KeyError from a malformed base element, must be
+		#called while handling it
+		if self.errors is None:
+			raise
+		e = UnexpectedError(error)
+		e.set_collection(coll)
+		if isinstance(element,dict) and "filename" in element:
+			e.set_base(element["filename"])
+		self.errors.append(e)
 
 class BaseElement:
 	def __init__(self,basefile,collname):
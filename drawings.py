@@ -15,32 +15,91 @@
 #License along with this library; if not, write to the Free Software
 #Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
-import yaml
-from os import listdir
+import re
+import struct
+from os import listdir, stat
 from glob import iglob
-from os.path import join, exists, splitext
-# pylint: disable=W0622
-from codecs import open
+from os.path import join, exists, splitext, dirname, basename, normpath
 
 from errors import *
-from common import BaseElement, DataBase, BOLTSParameters, check_schema
+from loader import load_document
+from common import BaseElement, DataBase, BOLTSParameters, Schema
+
+DRAWING_SCHEMA = Schema("drawing",
+	["filename","author","license","type","classids"],
+	["source"]
+)
+
+RE_SVG = re.compile("<svg\\b[^>]*>")
+RE_SVG_SIZE = re.compile("\\b(width|height)\\s*=\\s*[\"']\\s*([0-9.]+)")
+
+def scan_directory(path):
+	"Returns a dict of base names to dicts of extension and path of the files in path"
+	index = {}
+	for filename in listdir(path):
+		name, ext = splitext(filename)
+		if ext == "":
+			continue
+		index.setdefault(name,{})[ext[1:]] = join(path,filename)
+	return index
+
+def _image_size(filename,ext):
+	#width and height from the header of a png or svg file, or None
+	with open(filename,"rb") as fid:
+		head = fid.read(4096)
+	if ext == "png":
+		if head[:8] != "\x89PNG\r\n\x1a\n" or head[12:16] != "IHDR":
+			return None
+		return struct.unpack(">II",head[16:24])
+	if ext == "svg":
+		match = RE_SVG.search(head)
+		if match is None:
+			return None
+		size = dict(RE_SVG_SIZE.findall(match.group(0)))
+		if not ("width" in size and "height" in size):
+			return None
+		try:
+			return float(size["width"]), float(size["height"])
+		except ValueError:
+			return None
+	return None
 
 class Drawing(BaseElement):
-	def __init__(self,basefile,collname,backend_root):
+	def __init__(self,basefile,collname,backend_root,index=None):
 		BaseElement.__init__(self,basefile,collname)
-		check_schema(basefile,"drawing",
-			["filename","author","license","type","classids"],
-			["source"]
-		)
+		DRAWING_SCHEMA.check(basefile)
 		self.collection = collname
 		self.filename = basefile["filename"]
 		self.path = join(backend_root,collname,self.filename)
 		self.classids = basefile["classids"]
 
-		self.versions = {}
-	 	for version in iglob(self.path + ".*"):
-			ext = splitext(version)[1][1:]
-			self.versions[ext] = version
+		#index is the result of scan_directory for the directory of the drawing
+		if index is None:
+			self.versions = {}
+			for version in iglob(self.path + ".*"):
+				ext = splitext(version)[1][1:]
+				self.versions[ext] = version
+		else:
+			self.versions = dict(index.get(basename(self.path),{}))
+		#extension to metadata, computed on first request
+		self._metadata = {}
+
+	def get_metadata(self,ext):
+		"""
+		Returns a dict with size, mtime and for png and svg the image width
+		and height of the version with the given extension, or None
+		"""
+		if not ext in self.versions:
+			return None
+		if not ext in self._metadata:
+			filename = self.versions[ext]
+			info = stat(filename)
+			metadata = {"size" : info.st_size, "mtime" : info.st_mtime}
+			size = _image_size(filename,ext)
+			if not size is None:
+				metadata["width"], metadata["height"] = size
+			self._metadata[ext] = metadata
+		return self._metadata[ext]
 
 	def get_png(self):
 		if "png" not in self.versions:
@@ -53,32 +112,56 @@ class Drawing(BaseElement):
 		return self.versions["svg"]
 
 class DrawingsData(DataBase):
-	def __init__(self,path):
-		DataBase.__init__(self,"drawings", path)
+	def __init__(self,path,errors=None,documents=None):
+		DataBase.__init__(self,"drawings",path,errors,documents)
 		self.getbase = {}
 
 		if not exists(path):
 			e = MalformedRepositoryError("Repo directory does not exist")
 			e.set_repo_path(path)
-			raise e
+			self._report(e)
+			return
 		if not exists(join(self.backend_root)):
 			e = MalformedRepositoryError("drawings directory does not exist")
 			e.set_repo_path(path)
-			raise e
+			self._report(e)
+			return
+
+		#directory to its scan_directory index
+		self.indexes = {}
 
 		for coll in listdir(self.backend_root):
 			basefilename = join(self.backend_root,coll,"%s.base" % coll)
 			if not exists(basefilename):
 				#skip directory that is no collection
 				continue
-			base_info =  list(yaml.load_all(open(basefilename,"r","utf8")))
-			if len(base_info) != 1:
-				raise MalformedCollectionError(
-						"Not exactly one YAML document found in file %s" % basefilename)
-			base_info = base_info[0]
+			try:
+				base_info = load_document(basefilename,self.documents)
+			except ParsingError as e:
+				e.set_collection(coll)
+				self._report(e)
+				continue
 
 			for drawing_element in base_info:
-				draw = Drawing(drawing_element, coll, self.backend_root)
+				try:
+					draw = Drawing(drawing_element, coll, self.backend_root,
+						self._get_index(join(self.backend_root,coll,
+							dirname(drawing_element.get("filename","")))))
+				except ParsingError as e:
+					e.set_base(drawing_element.get("filename"))
+					e.set_collection(coll)
+					self._report(e)
+					continue
+				except (ValueError,KeyError) as e:
+					self._report_unexpected(e,coll,drawing_element)
+					continue
 
-				for id in drawing_element["classids"]:
+				for id in draw.classids:
 					self.getbase[id] = draw
+
+	def _get_index(self,path):
+		#each directory is only scanned once
+		path = normpath(path)
+		if not path in self.indexes:
+			self.indexes[path] = scan_directory(path) if exists(path) else {}
+		return self.indexes[path]
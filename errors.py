@@ -15,6 +15,12 @@
 #License along with this library; if not, write to the Free Software
 #Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
+def _restore_parsing_error(cls,msg,trace_info):
+	e = Exception.__new__(cls)
+	e.msg = msg
+	e.trace_info = trace_info
+	return e
+
 class ParsingError(Exception):
 	def __init__(self):
 		Exception.__init__(self)
@@ -28,10 +34,15 @@ class ParsingError(Exception):
 		self.trace_info["Class"] = cl
 	def set_base(self,base):
 		self.trace_info["Base"] = base
+	def set_backend(self,backend):
+		self.trace_info["Backend"] = backend
 	def __str__(self):
 		trace = " ".join("%s: %s" % (k,str(v))
 			for k,v in self.trace_info.iteritems())
 		return "%s.  %s" % (self.msg, trace)
+	def __reduce__(self):
+		#subclass constructors take different arguments, so pickle the state
+		return (_restore_parsing_error,(self.__class__,self.msg,self.trace_info))
 
 class VersionError(ParsingError):
 	def __init__(self,version):
@@ -63,6 +74,11 @@ class MalformedBaseError(ParsingError):
 		ParsingError.__init__(self)
 		self.msg = msg
 
+class UnexpectedError(ParsingError):
+	def __init__(self,error):
+		ParsingError.__init__(self)
+		self.msg = "%s: %s" % (error.__class__.__name__,error)
+
 class MalformedStringError(ParsingError):
 	def __init__(self,msg):
 		ParsingError.__init__(self)
@@ -13,14 +13,26 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import yaml
+import os
+import hashlib
 from os import listdir
 from os.path import join, exists, basename, splitext
-# pylint: disable=W0622
-from codecs import open
 
-from common import check_schema, DataBase, BaseElement, BOLTSParameters
+from common import Schema, DataBase, BaseElement, BOLTSParameters
 from errors import *
+from loader import load_document, read_file
+from cache import LRUCache, file_stamp
+
+FUNCTION_SCHEMA = Schema("basefunction",["name","classids"],["parameters"])
+BASEFUNCTION_SCHEMA = Schema("basefunction",
+	["filename","author","license","type","functions"],
+	["source"]
+)
+BASEFCSTD_SCHEMA = Schema("basefcstd",
+	["filename","author","license","type","objects"],
+	["source"]
+)
+OBJECT_SCHEMA = Schema("basefcstd",["objectname","classids"],["proptoparam","parameters"])
 
 class FreeCADGeometry(BaseElement):
 	def __init__(self,basefile,collname,backend_root):
@@ -30,14 +42,8 @@ class FreeCADGeometry(BaseElement):
 
 class BaseFunction(FreeCADGeometry):
 	def __init__(self,function,basefile,collname,backend_root):
-		check_schema(function,"basefunction",
-			["name","classids"],
-			["parameters"]
-		)
-		check_schema(basefile,"basefunction",
-			["filename","author","license","type","functions"],
-			["source"]
-		)
+		FUNCTION_SCHEMA.check(function)
+		BASEFUNCTION_SCHEMA.check(basefile)
 
 		FreeCADGeometry.__init__(self,basefile,collname,backend_root)
 		self.name = function["name"]
@@ -50,13 +56,8 @@ class BaseFunction(FreeCADGeometry):
 
 class BaseFcstd(FreeCADGeometry):
 	def __init__(self,obj,basefile, collname,backend_root):
-		check_schema(basefile,"basefcstd",
-			["filename","author","license","type","objects"],
-			["source"])
-		check_schema(obj,"basefcstd",
-			["objectname","classids"],
-			["proptoparam","parameters"]
-		)
+		BASEFCSTD_SCHEMA.check(basefile)
+		OBJECT_SCHEMA.check(obj)
 
 		FreeCADGeometry.__init__(self,basefile,collname,backend_root)
 		self.objectname = obj["objectname"]
@@ -71,57 +72,160 @@ class BaseFcstd(FreeCADGeometry):
 		self.classids = obj["classids"]
 
 class FreeCADData(DataBase):
-	def __init__(self,path):
-		DataBase.__init__(self,"freecad",path)
+	def __init__(self,path,errors=None,documents=None):
+		DataBase.__init__(self,"freecad",path,errors,documents)
 		self.getbase = {}
 
 		if not exists(path):
 			e = MalformedRepositoryError("Repo directory does not exist")
 			e.set_repo_path(path)
-			raise e
+			self._report(e)
+			return
 		if not exists(join(self.backend_root)):
 			e = MalformedRepositoryError("freecad directory does not exist")
 			e.set_repo_path(path)
-			raise e
+			self._report(e)
+			return
 
 		for coll in listdir(self.backend_root):
 			basefilename = join(self.backend_root,coll,"%s.base" % coll)
 			if not exists(basefilename):
 				#skip directory that is no collection
 				continue
-			base_info =  list(yaml.load_all(open(basefilename,"r","utf8")))
-			if len(base_info) != 1:
-				raise MalformedCollectionError(
-						"Not exactly one YAML document found in file %s" % basefilename)
-			base_info = base_info[0]
+			try:
+				base_info = load_document(basefilename,self.documents)
+			except ParsingError as e:
+				e.set_collection(coll)
+				self._report(e)
+				continue
 			for basefile in base_info:
-				if basefile["type"] == "function":
-					basepath = join(self.backend_root,coll,"%s.py" % coll)
-					if not exists(basepath):
-						raise MalformedBaseError("Python module %s does not exist" % basepath)
-					for func in basefile["functions"]:
-						try:
-							function = BaseFunction(func,basefile,coll,self.backend_root)
-							for id in func["classids"]:
-								if id in self.getbase:
-									raise NonUniqueBaseError(id)
-								self.getbase[id] = function
-						except ParsingError as e:
-							e.set_base(basefile["filename"])
-							e.set_collection(coll)
-							raise e
-				elif basefile["type"] == "fcstd":
-					basepath = join(self.backend_root,coll,basefile["filename"])
-					if not exists(basepath):
-						continue
-					for obj in basefile["objects"]:
-						try:
-							fcstd = BaseFcstd(obj,basefile,coll,self.backend_root)
-							for id in obj["classids"]:
-								if id in self.getbase:
-									raise NonUniqueBaseError(id)
-								self.getbase[id] = fcstd
-						except ParsingError as e:
-							e.set_base(basefile["filename"])
-							e.set_collection(coll)
-							raise e
+				try:
+					self._add_basefile(basefile,coll)
+				except (ValueError,KeyError) as e:
+					self._report_unexpected(e,coll,basefile)
+
+	def _add_basefile(self,basefile,coll):
+		if basefile["type"] == "function":
+			basepath = join(self.backend_root,coll,"%s.py" % coll)
+			if not exists(basepath):
+				e = MalformedBaseError("Python module %s does not exist" % basepath)
+				e.set_collection(coll)
+				self._report(e)
+				return
+			for func in basefile["functions"]:
+				try:
+					function = BaseFunction(func,basefile,coll,self.backend_root)
+					for id in func["classids"]:
+						if id in self.getbase:
+							raise NonUniqueBaseError(id)
+						self.getbase[id] = function
+				except ParsingError as e:
+					e.set_base(basefile["filename"])
+					e.set_collection(coll)
+					self._report(e)
+				except (ValueError,KeyError) as e:
+					self._report_unexpected(e,coll,basefile)
+		elif basefile["type"] == "fcstd":
+			basepath = join(self.backend_root,coll,basefile["filename"])
+			if not exists(basepath):
+				return
+			for obj in basefile["objects"]:
+				try:
+					fcstd = BaseFcstd(obj,basefile,coll,self.backend_root)
+					for id in obj["classids"]:
+						if id in self.getbase:
+							raise NonUniqueBaseError(id)
+						self.getbase[id] = fcstd
+				except ParsingError as e:
+					e.set_base(basefile["filename"])
+					e.set_collection(coll)
+					self._report(e)
+				except (ValueError,KeyError) as e:
+					self._report_unexpected(e,coll,basefile)
+
+class GeometryCache:
+	"""
+	Cache for shapes built by base functions, keyed by class id, base and
+	the collected parameters. Shapes are kept in memory with LRU eviction
+	and, if path is given, stored on disk as BREP. Parts always get a copy
+	of the cached shape. part is the FreeCAD Part module, it is imported
+	when needed if not given.
+	"""
+	def __init__(self,maxsize=128,path=None,part=None):
+		self.shapes = LRUCache(maxsize)
+		self.path = path
+		self.part = part
+		self.disk_hits = 0
+		#path of base file to its stamp, base code is part of the disk key
+		self._stamps = {}
+
+	def _get_part(self):
+		if self.part is None:
+			import Part
+			self.part = Part
+		return self.part
+
+	def get_key(self,classid,base,params):
+		#the name only labels the object, it does not change the shape
+		values = tuple(sorted((k,v) for k,v in params.iteritems() if k != "name"))
+		return (classid,base.collection,base.filename,base.name,values)
+
+	def _get_filename(self,key,base):
+		if not base.path in self._stamps:
+			self._stamps[base.path] = file_stamp(read_file(base.path))
+		digest = hashlib.sha1(repr((key,self._stamps[base.path]))).hexdigest()
+		return join(self.path,"%s_%s.brep" % (key[0],digest))
+
+	def get_shape(self,classid,base,params):
+		"Returns a copy of the cached shape or None"
+		key = self.get_key(classid,base,params)
+		shape = self.shapes.get(key)
+		if shape is None and not self.path is None:
+			filename = self._get_filename(key,base)
+			if exists(filename):
+				shape = self._get_part().Shape()
+				shape.importBrepFromString(read_file(filename))
+				self.shapes.put(key,shape)
+				self.disk_hits += 1
+		if shape is None:
+			return None
+		return shape.copy()
+
+	def put_shape(self,classid,base,params,shape):
+		key = self.get_key(classid,base,params)
+		shape = shape.copy()
+		self.shapes.put(key,shape)
+		if not self.path is None:
+			if not exists(self.path):
+				os.makedirs(self.path)
+			filename = self._get_filename(key,base)
+			tmpname = "%s.%d.tmp" % (filename,os.getpid())
+			with open(tmpname,"wb") as fid:
+				fid.write(shape.exportBrepToString())
+			os.rename(tmpname,filename)
+
+	def add_part(self,classid,base,function,params,document):
+		"""
+		Adds a part for a class to document, like function(params,document)
+		of the base function, which is only called if the shape is not cached
+		"""
+		shape = self.get_shape(classid,base,params)
+		if shape is None:
+			function(params,document)
+			part = document.Objects[-1]
+			self.put_shape(classid,base,params,part.Shape)
+			return part
+		part = document.addObject("Part::Feature",params["name"])
+		part.Shape = shape
+		return part
+
+	def invalidate(self,classids):
+		"Drops the shapes of the given classes from memory and disk"
+		self.shapes.invalidate(classids)
+		if self.path is None or not exists(self.path):
+			return
+		classids = set(classids)
+		for filename in listdir(self.path):
+			#file names are class id, _, 40 digits of digest and .brep
+			if filename.endswith(".brep") and filename[:-46] in classids:
+				os.remove(join(self.path,filename))
@@ -0,0 +1,87 @@
+#bolttools - a framework for creation of part libraries
+#Copyright (C) 2013 Johannes Reinhardt <jreinhardt@ist-dein-freund.de>
+#
+#This library is free software; you can redistribute it and/or
+#modify it under the terms of the GNU Lesser General Public
+#License as published by the Free Software Foundation; either
+#version 2.1 of the License, or any later version.
+#
+#This library is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#Lesser General Public License for more details.
+#
+#You should have received a copy of the GNU Lesser General Public
+#License along with this library; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+#loading of the YAML documents of blt and base files
+
+import yaml
+from os.path import abspath
+
+#the libyaml based loader is much faster, but not always available
+try:
+	from yaml import CSafeLoader as Loader
+except ImportError:
+	from yaml import SafeLoader as Loader
+
+from errors import *
+from cache import file_stamp
+
+def read_file(filename):
+	with open(filename,"rb") as fid:
+		return fid.read()
+
+def parse_document(data,filename):
+	"Parses data that has to contain exactly one YAML document"
+	loader = Loader(data)
+	try:
+		if not loader.check_data():
+			raise MalformedCollectionError(
+					"No YAML document found in file %s" % filename)
+		document = loader.get_data()
+		#this only parses up to the start of a second document
+		if loader.check_data():
+			raise MalformedCollectionError(
+					"More than one YAML document found in file %s" % filename)
+	finally:
+		loader.dispose()
+	return document
+
+class DocumentCache:
+	"""
+	Parsed YAML documents by file name, valid as long as the content of the
+	file does not change. The documents are shared, they must not be modified.
+	Can be passed to the repository and the databases to share parsing work,
+	it is dropped with them.
+	"""
+	def __init__(self):
+		self.documents = {}
+		self.hits = 0
+		self.misses = 0
+
+	def parse(self,data,filename,stamp=None):
+		"Parses data read from filename, reusing earlier results for the same content"
+		if stamp is None:
+			stamp = file_stamp(data)
+		key = abspath(filename)
+		if key in self.documents and self.documents[key][0] == stamp:
+			self.hits += 1
+			return self.documents[key][1]
+		self.misses += 1
+		document = parse_document(data,filename)
+		self.documents[key] = (stamp,document)
+		return document
+
+	def load(self,filename):
+		return self.parse(read_file(filename),filename)
+
+	def clear(self):
+		self.documents = {}
+
+def load_document(filename,documents=None):
+	"Loads the single YAML document in filename, through a DocumentCache if given"
+	if documents is None:
+		return parse_document(read_file(filename),filename)
+	return documents.load(filename)
@@ -15,15 +15,28 @@
 #License along with this library; if not, write to the Free Software
 #Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
-import yaml
+import os
+import re
+import hashlib
 from os import listdir
-from os.path import join, exists
-# pylint: disable=W0622
-from codecs import open
+from os.path import join, exists, dirname, basename
+from multiprocessing import Pool
 
 from errors import *
-from common import DataBase, BaseElement, BOLTSParameters, check_schema
+from loader import load_document, read_file
+from cache import file_stamp, load_manifest, save_manifest
+from common import DataBase, BaseElement, BOLTSParameters, Schema, sort_choices
 
+MODULE_SCHEMA = Schema("basemodule",
+	["name", "arguments","classids"],
+	["parameters","connectors"])
+BASEMODULE_SCHEMA = Schema("basemodule",
+	["filename","author","license","type","modules"],
+	["source"])
+BASESTL_SCHEMA = Schema("basestl",
+	["filename","author","license","type","classids"],
+	["source"])
+CONNECTORS_SCHEMA = Schema("connectors",["name","arguments","locations"],[])
 
 class OpenSCADGeometry(BaseElement):
 	def __init__(self,basefile,collname):
@@ -39,16 +52,15 @@ class OpenSCADGeometry(BaseElement):
 	def get_incantation(self,args):
 		"Return the incantation of the base that produces the geometry"
 		raise NotImplementedError
+	def get_arguments(self):
+		"Returns the names of the parameters used by the incantation"
+		raise NotImplementedError
 
 
 class BaseModule(OpenSCADGeometry):
 	def __init__(self,mod,basefile,collname):
-		check_schema(mod,"basemodule",
-			["name", "arguments","classids"],
-			["parameters","connectors"])
-		check_schema(basefile,"basemodule",
-			["filename","author","license","type","modules"],
-			["source"])
+		MODULE_SCHEMA.check(mod)
+		BASEMODULE_SCHEMA.check(basefile)
 
 		OpenSCADGeometry.__init__(self,basefile,collname)
 		self.name = mod["name"]
@@ -70,13 +82,13 @@ class BaseModule(OpenSCADGeometry):
 		return [self.filename]
 	def get_incantation(self,args):
 		return "%s(%s)" % (self.name,", ".join(args[arg] for arg in self.arguments))
+	def get_arguments(self):
+		return self.arguments
 
 
 class BaseSTL(OpenSCADGeometry):
 	def __init__(self,basefile,collname):
-		check_schema(basefile,"basestl",
-			["filename","author","license","type","classids"],
-			["source"])
+		BASESTL_SCHEMA.check(basefile)
 		OpenSCADGeometry.__init__(self,basefile,collname)
 		self.classids = basefile["classids"]
 
@@ -91,12 +103,12 @@ class BaseSTL(OpenSCADGeometry):
 		return []
 	def get_incantation(self,args):
 		return 'import("%s")' % join("base",self.filename)
+	def get_arguments(self):
+		return []
 
 class Connectors:
 	def __init__(self,cs):
-		check_schema(cs,"connectors",
-			["name","arguments","locations"],
-			[])
+		CONNECTORS_SCHEMA.check(cs)
 		self.name = cs["name"]
 		self.arguments = cs["arguments"]
 		if not "location" in self.arguments:
@@ -105,49 +117,365 @@ class Connectors:
 
 
 class OpenSCADData(DataBase):
-	def __init__(self,path):
-		DataBase.__init__(self,"openscad",path)
+	def __init__(self,path,errors=None,documents=None):
+		DataBase.__init__(self,"openscad",path,errors,documents)
 		#maps class id to base module
 		self.getbase = {}
 
 		if not exists(path):
 			e = MalformedRepositoryError("Repo directory does not exist")
 			e.set_repo_path(path)
-			raise e
+			self._report(e)
+			return
 		if not exists(join(self.backend_root)):
 			e = MalformedRepositoryError("openscad directory does not exist")
 			e.set_repo_path(path)
-			raise e
+			self._report(e)
+			return
 
 		for coll in listdir(self.backend_root):
 			basefilename = join(self.backend_root,coll,"%s.base" % coll)
 			if not exists(basefilename):
 				#skip directory that is no collection
 				continue
-			base =  list(yaml.load_all(open(basefilename,"r","utf8")))
-			if len(base) != 1:
-				raise MalformedCollectionError(
-						"No YAML document found in file %s" % basefilename)
-			base = base[0]
+			try:
+				base = load_document(basefilename,self.documents)
+			except ParsingError as e:
+				e.set_collection(coll)
+				self._report(e)
+				continue
 			for basefile in base:
-				if basefile["type"] == "module":
-					for mod in basefile["modules"]:
-						try:
-							module = BaseModule(mod,basefile,coll)
-							for id in module.classids:
-								if id in self.getbase:
-									raise NonUniqueBaseError(id)
-								self.getbase[id] = module
-						except ParsingError as e:
-							e.set_base(basefile["filename"])
-							raise e
-				elif basefile["type"] == "stl":
-					try:
-						module = BaseSTL(basefile,coll)
-						for id in module.classids:
-							if id in self.getbase:
-								raise NonUniqueBaseError(id)
-							self.getbase[id] = module
-					except ParsingError as e:
-						e.set_base(basefile["filename"])
-						raise e
+				try:
+					self._add_basefile(basefile,coll)
+				except (ValueError,KeyError) as e:
+					self._report_unexpected(e,coll,basefile)
+
+	def _add_basefile(self,basefile,coll):
+		if basefile["type"] == "module":
+			for mod in basefile["modules"]:
+				try:
+					module = BaseModule(mod,basefile,coll)
+					for id in module.classids:
+						if id in self.getbase:
+							raise NonUniqueBaseError(id)
+						self.getbase[id] = module
+				except ParsingError as e:
+					e.set_base(basefile["filename"])
+					e.set_collection(coll)
+					self._report(e)
+				except (ValueError,KeyError) as e:
+					self._report_unexpected(e,coll,basefile)
+		elif basefile["type"] == "stl":
+			try:
+				module = BaseSTL(basefile,coll)
+				for id in module.classids:
+					if id in self.getbase:
+						raise NonUniqueBaseError(id)
+					self.getbase[id] = module
+			except ParsingError as e:
+				e.set_base(basefile["filename"])
+				e.set_collection(coll)
+				self._report(e)
+
+#increase when the generated output changes
+EXPORT_VERSION = 4
+MANIFEST_NAME = ".manifest"
+
+RE_IDENTIFIER = re.compile("[^A-Za-z0-9_]")
+
+def _scad_value(value):
+	#OpenSCAD literal for a parameter value
+	if value is None:
+		return "undef"
+	if isinstance(value,bool):
+		return "true" if value else "false"
+	if isinstance(value,(int,long,float)):
+		return repr(value)
+	return '"%s"' % str(value).replace("\\","\\\\").replace('"','\\"')
+
+def _scad_list(values):
+	return "[%s]" % ", ".join(_scad_value(value) for value in values)
+
+class _ClassTables:
+	#sorted arrays of the table columns of a class that are consumed by
+	#its base, and the positions of the table indexes in them
+	def __init__(self,cl,params,consumed):
+		self.cl = cl
+		self.params = params
+		self.arrays = []
+		self.lookups = []
+		self.args = {}
+		#table index parameter to its sorted keys
+		self.keys = {}
+
+		for table in params.tables:
+			rows = table.data
+			for i, column in enumerate(table.columns):
+				if not column in consumed or column in self.args:
+					continue
+				keys = self._get_keys(table.index,rows.keys())
+				values = [rows.get_value(key,i) if key in rows else None for key in keys]
+				self._add_array(column,_scad_list(values))
+				self.args[column] = "%s_%s[%s_pos]" % (cl.id,column,table.index)
+		for table in params.tables2d:
+			if not table.result in consumed or table.result in self.args:
+				continue
+			rows = table.data
+			rowkeys = self._get_keys(table.rowindex,rows.keys())
+			colkeys = self._get_keys(table.colindex,table.columns)
+			positions = [table.columns.index(key) for key in colkeys]
+			#nested direct index, rows first
+			nested = []
+			for key in rowkeys:
+				if key in rows:
+					nested.append(_scad_list(rows.get_value(key,i) for i in positions))
+				else:
+					nested.append(_scad_list(None for i in positions))
+			self._add_array(table.result,"[\n\t%s\n]" % ",\n\t".join(nested))
+			self.args[table.result] = "%s_%s[%s_pos][%s_pos]" % \
+				(cl.id,table.result,table.rowindex,table.colindex)
+
+	def _get_keys(self,pname,keys):
+		if not pname in self.keys:
+			#choices are sorted and allowed by all tables
+			if pname in self.params.choices:
+				keys = self.params.choices[pname]
+			else:
+				keys = sort_choices(keys)
+			self.keys[pname] = keys
+			self._add_array("%s_keys" % pname,_scad_list(keys))
+			#the position is looked up once for all tables using the index
+			self.lookups.append("%s_pos = search([%s],%s_%s_keys)[0];" %
+				(pname,pname,self.cl.id,pname))
+		return self.keys[pname]
+
+	def _add_array(self,name,content):
+		self.arrays.append("%s_%s = %s;" % (self.cl.id,name,content))
+
+def _class_modules(cl,names,base,params,tables):
+	#wrapper modules for all names of a class
+	args = dict(tables.args)
+	for pname, value in params.literal.iteritems():
+		args[pname] = _scad_value(value)
+	defaults = []
+	for pname in params.free:
+		args[pname] = pname
+		default = params.defaults.get(pname)
+		if params.types[pname] == "Table Index" and not default and params.choices.get(pname):
+			default = params.choices[pname][0]
+		defaults.append("%s=%s" % (pname,_scad_value(default)))
+	body = "".join("\t%s\n" % lookup for lookup in tables.lookups)
+	if isinstance(base,BaseSTL):
+		#import paths are relative to the calling file, which the exporter
+		#writes to modules/ or bundles/
+		body += '\timport("%s");\n' % join("..","base",base.filename)
+	else:
+		body += "\t%s;\n" % base.get_incantation(args)
+	modules = []
+	for name in names:
+		modules.append("module %s(%s){\n%s}" %
+			(RE_IDENTIFIER.sub("_",name),", ".join(defaults),body))
+	return modules
+
+HEADER = "//generated by bolttools, changes will be overwritten\n"
+
+def _export_collection(job):
+	#entry point for the worker processes, returns the table arrays and the
+	#wrapper modules of a collection
+	collid, classes = job
+	arrays = []
+	modules = []
+	for cl, names, base, params in classes:
+		tables = _ClassTables(cl,params,base.get_arguments())
+		arrays += tables.arrays
+		modules += _class_modules(cl,names,base,params,tables)
+	return "\n\n".join(arrays) + "\n", "\n\n".join(modules) + "\n"
+
+def _get_includes(classes):
+	#base files included by the classes of a collection, in order
+	includes = []
+	for cl, names, base, params in classes:
+		for filename in base.get_include_files():
+			if not filename in includes:
+				includes.append(filename)
+	return includes
+
+def _include(rel):
+	return "include <%s>\n" % rel
+
+class OpenSCADExporter:
+	"""
+	Writes an OpenSCAD library for a repository and its OpenSCAD backend.
+	Collections are exported in parallel if processes is given. A manifest
+	of content stamps in the output directory lets later runs skip
+	collections whose inputs did not change and only rewrite changed files.
+
+	Every file is included only once by the library file BOLTS.scad. With
+	bundle, the base files used by a single collection are concatenated
+	with its tables and modules into one file in bundles/.
+	"""
+	def __init__(self,repo,data,processes=None,bundle=False):
+		self.repo = repo
+		self.data = data
+		self.processes = processes
+		self.bundle = bundle
+		#relative paths of the outputs of the last run
+		self.written = []
+		self.skipped = []
+
+	def _get_jobs(self):
+		#collection id to job and stamp of all inputs of the collection
+		jobs = []
+		base_stamps = {}
+		for coll in self.repo.collections:
+			names = {}
+			for cl in coll.classes:
+				names.setdefault(cl.id,[]).append(cl.name)
+			classes = []
+			stamp = hashlib.sha1("%d %s" % (EXPORT_VERSION,self.repo.get_stamp(coll.id)))
+			for cl in coll.classes_by_ids():
+				if not cl.id in self.data.getbase:
+					continue
+				base = self.data.getbase[cl.id]
+				classes.append((cl,names[cl.id],base,self.data.get_parameters(cl)))
+				if not base.collection in base_stamps:
+					base_stamps[base.collection] = self._get_base_stamp(base.collection)
+				stamp.update(base_stamps[base.collection])
+			if len(classes) > 0:
+				jobs.append(((coll.id,classes),stamp))
+		return jobs
+
+	def _get_base_stamp(self,collname):
+		#stamp of the base file and all files of a backend collection
+		stamp = hashlib.sha1()
+		path = join(self.data.backend_root,collname)
+		for filename in sorted(listdir(path)):
+			stamp.update(filename)
+			stamp.update(file_stamp(read_file(join(path,filename))))
+		return stamp.hexdigest()
+
+	def _get_sources(self,classes):
+		#base file name to path of the file in the backend
+		sources = {}
+		for cl, names, base, params in classes:
+			for path in base.get_copy_files():
+				sources[basename(path)] = join(self.data.backend_root,path)
+		return sources
+
+	def write_output(self,out_path):
+		"Writes the library to out_path, returns the relative paths of all outputs"
+		if not exists(out_path):
+			os.makedirs(out_path)
+		manifest = load_manifest(join(out_path,MANIFEST_NAME),EXPORT_VERSION,
+			{"collections" : {}, "files" : {}})
+		files = {}
+		collections = {}
+		self.written = []
+		self.skipped = []
+
+		all_jobs = self._get_jobs()
+
+		#base files included by more than one collection
+		includes = {}
+		users = {}
+		for job, stamp in all_jobs:
+			collid, classes = job
+			includes[collid] = _get_includes(classes)
+			for filename in includes[collid]:
+				users.setdefault(filename,set()).add(collid)
+		shared = set(filename for filename in users if len(users[filename]) > 1)
+
+		jobs = []
+		for job, stamp in all_jobs:
+			collid = job[0]
+			#the outputs also depend on the layout and the sharing of bases
+			stamp.update(repr((self.bundle,[f for f in includes[collid] if f in shared])))
+			stamp = stamp.hexdigest()
+			outputs = manifest["collections"].get(collid)
+			if not outputs is None and outputs[0] == stamp and \
+					all(exists(join(out_path,rel)) for rel in outputs[1]):
+				#nothing changed, keep the outputs of the last run
+				for rel in outputs[1]:
+					files[rel] = manifest["files"][rel]
+				collections[collid] = outputs
+				self.skipped.append(collid)
+			else:
+				jobs.append((job,stamp))
+
+		if self.processes is None or self.processes < 2 or len(jobs) < 2:
+			results = [_export_collection(job) for job, stamp in jobs]
+		else:
+			pool = Pool(min(self.processes,len(jobs)))
+			try:
+				results = pool.map(_export_collection,[job for job, stamp in jobs])
+			finally:
+				pool.close()
+				pool.join()
+
+		for (job, stamp), (arrays, modules) in zip(jobs,results):
+			collid, classes = job
+			sources = self._get_sources(classes)
+			outputs = []
+			if self.bundle:
+				bundled = [f for f in includes[collid] if not f in shared]
+				parts = [read_file(sources[filename]) for filename in bundled]
+				rel = join("bundles","%s.scad" % collid)
+				outputs.append((rel,HEADER + "\n".join(parts + [arrays,modules])))
+				wrapper = [join("base",f) for f in includes[collid] if f in shared] + [rel]
+			else:
+				bundled = []
+				table = join("tables","%s.scad" % collid)
+				module = join("modules","%s.scad" % collid)
+				outputs.append((table,HEADER + arrays))
+				outputs.append((module,HEADER + modules))
+				wrapper = [join("base",f) for f in includes[collid]] + [table,module]
+			#included by users that only need a single collection
+			outputs.append(("%s.scad" % collid,HEADER + "".join(_include(rel) for rel in wrapper)))
+			for filename in sorted(sources):
+				if not filename in bundled:
+					outputs.append((join("base",filename),read_file(sources[filename])))
+
+			rels = []
+			for rel, content in outputs:
+				rels.append(rel)
+				files[rel] = self._write(out_path,manifest,rel,content)
+			collections[collid] = (stamp,rels)
+
+		#the library includes every file once
+		library = []
+		for job, stamp in all_jobs:
+			collid = job[0]
+			for filename in includes[collid]:
+				rel = join("base",filename)
+				if (filename in shared or not self.bundle) and not rel in library:
+					library.append(rel)
+		for collid in sorted(collections):
+			if self.bundle:
+				library.append(join("bundles","%s.scad" % collid))
+			else:
+				library.append(join("tables","%s.scad" % collid))
+				library.append(join("modules","%s.scad" % collid))
+		content = HEADER + "".join(_include(rel) for rel in library)
+		files["BOLTS.scad"] = self._write(out_path,manifest,"BOLTS.scad",content)
+
+		#remove outputs that are no longer produced
+		for rel in manifest["files"]:
+			if not rel in files and exists(join(out_path,rel)):
+				os.remove(join(out_path,rel))
+
+		save_manifest(join(out_path,MANIFEST_NAME),EXPORT_VERSION,
+			{"collections" : collections, "files" : files})
+		return sorted(files)
+
+	def _write(self,out_path,manifest,rel,content):
+		#writes content if it differs from the last run, returns its stamp
+		stamp = file_stamp(content)
+		filename = join(out_path,rel)
+		if manifest["files"].get(rel) == stamp and exists(filename):
+			return stamp
+		if not exists(dirname(filename)):
+			os.makedirs(dirname(filename))
+		with open(filename,"wb") as fid:
+			fid.write(content)
+		self.written.append(rel)
+		return stamp
@@ -0,0 +1,141 @@
+#bolttools - a framework for creation of part libraries
+#Copyright (C) 2013 Johannes Reinhardt <jreinhardt@ist-dein-freund.de>
+#
+#This library is free software; you can redistribute it and/or
+#modify it under the terms of the GNU Lesser General Public
+#License as published by the Free Software Foundation; either
+#version 2.1 of the License, or any later version.
+#
+#This library is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#Lesser General Public License for more details.
+#
+#You should have received a copy of the GNU Lesser General Public
+#License along with this library; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+#full text search over the classes of a repository
+
+import re
+from bisect import bisect_left
+from heapq import nsmallest
+
+from cache import LRUCache
+
+#prefixes of standard numbers, in addition to the bodies of the repository
+STANDARD_BODIES = ["din","iso","en","dinen","diniso","eniso","dineniso","ansi",
+	"asme","bs","jis","nf","uni"]
+
+#weights of the fields of a class
+WEIGHTS = {
+	"name" : 8,
+	"standard" : 6,
+	"description" : 2,
+	"collection" : 1,
+	"notes" : 1
+}
+
+RE_SPLIT = re.compile("[^a-z0-9.]+")
+
+def tokenize(text,bodies=STANDARD_BODIES):
+	"""
+	Splits text into lowercase tokens. A standard body followed by a number
+	is joined, so DIN912, DIN 912 and din-912 all give din912, as are
+	composite bodies like DIN EN ISO.
+	"""
+	tokens = []
+	for token in RE_SPLIT.split(text.lower()):
+		token = token.strip(".")
+		if token == "":
+			continue
+		if tokens and tokens[-1] in bodies and \
+				(token[0].isdigit() or tokens[-1] + token in bodies):
+			tokens[-1] += token
+		else:
+			tokens.append(token)
+	return tokens
+
+def _suffixes(token,bodies):
+	#trailing bodies with the number of a joined standard, so that
+	#dineniso4017 is also found as eniso4017 and iso4017
+	i = 0
+	while i < len(token) and token[i].isalpha():
+		i += 1
+	prefix, number = token[:i], token[i:]
+	if number == "" or not prefix in bodies:
+		return []
+	return [prefix[j:] + number for j in range(1,len(prefix)) if prefix[j:] in bodies]
+
+class SearchIndex:
+	"""
+	Inverted index over name, standard, description and notes of the classes
+	of a BOLTSRepository and the names of their collections. Query tokens
+	match index tokens by prefix, results are ranked by the weights of the
+	matching fields.
+	"""
+	def __init__(self,repo,cachesize=256):
+		self.bodies = set(STANDARD_BODIES)
+		self.bodies.update(body.lower() for body in repo.standard_bodies)
+
+		#all names of a class are separate entries
+		self.classes = []
+		postings = {}
+		for coll in repo.collections:
+			for cl in coll.classes:
+				entry = len(self.classes)
+				self.classes.append(cl)
+				fields = [("name",cl.name),("description",cl.description),
+					("collection",coll.name),("notes",cl.notes)]
+				if not cl.standard is None:
+					fields += [("standard",std) for std in cl.standard]
+				for field, text in fields:
+					if not text:
+						continue
+					for token in tokenize(text,self.bodies):
+						for token in [token] + _suffixes(token,self.bodies):
+							weights = postings.setdefault(token,{})
+							weights[entry] = max(weights.get(entry,0),WEIGHTS[field])
+		self.postings = postings
+		self.tokens = sorted(postings)
+		#typing a query repeats the same prefixes
+		self.prefix_cache = LRUCache(cachesize)
+
+	def _match_prefix(self,prefix):
+		#returns entry to score for all tokens starting with prefix
+		res = self.prefix_cache.get(prefix)
+		if not res is None:
+			return res
+		res = {}
+		tokens = self.tokens
+		i = bisect_left(tokens,prefix)
+		while i < len(tokens) and tokens[i].startswith(prefix):
+			token = tokens[i]
+			#exact matches rank above prefix matches
+			factor = 2 if token == prefix else 1
+			for entry, weight in self.postings[token].iteritems():
+				score = factor*weight
+				if score > res.get(entry,0):
+					res[entry] = score
+			i += 1
+		self.prefix_cache.put(prefix,res)
+		return res
+
+	def search(self,query,limit=None):
+		"""
+		Returns the classes matching all tokens of query, best matches first
+		"""
+		tokens = tokenize(query,self.bodies)
+		if len(tokens) == 0:
+			return []
+		matches = sorted((self._match_prefix(token) for token in tokens),key=len)
+		scores = matches[0]
+		for match in matches[1:]:
+			scores = dict((entry,score + match[entry])
+				for entry, score in scores.iteritems() if entry in match)
+		key = lambda e: (-scores[e],self.classes[e].name)
+		if limit is None:
+			ranked = sorted(scores,key=key)
+		else:
+			ranked = nsmallest(limit,scores,key=key)
+		return [self.classes[entry] for entry in ranked]
@@ -15,22 +15,34 @@
 #License along with this library; if not, write to the Free Software
 #Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
-import yaml
+import os
+import hashlib
 from os import listdir
 from glob import iglob
 from os.path import join, exists, splitext
-# pylint: disable=W0622
-from codecs import open
+from shutil import copyfile
+from multiprocessing import Pool
+
+#only needed to write design tables
+try:
+	import xlwt
+except ImportError:
+	xlwt = None
 
 from errors import *
-from common import BaseElement, DataBase, BOLTSParameters, BOLTSNaming, check_schema
+from loader import load_document, read_file
+from cache import file_stamp, load_manifest, save_manifest
+from common import BaseElement, DataBase, BOLTSParameters, BOLTSNaming, Schema
+
+CLASS_SCHEMA = Schema("basesolidworks",["classid"],["naming"])
+DESIGNTABLE_SCHEMA = Schema("basesolidworks",
+	["filename","author","license","type","suffix","params","classes"],
+	["source","metadata"]
+)
 
 class DesignTableClass:
 	def __init__(self,cl):
-		check_schema(cl,"basesolidworks",
-			["classid"],
-			["naming"]
-		)
+		CLASS_SCHEMA.check(cl)
 
 		self.classid = cl["classid"]
 		
@@ -42,10 +54,7 @@ class DesignTableClass:
 class DesignTable(BaseElement):
 	def __init__(self,designtable,collname,backend_root):
 		BaseElement.__init__(self,designtable,collname)
-		check_schema(designtable,"basesolidworks",
-			["filename","author","license","type","suffix","params","classes"],
-			["source","metadata"]
-		)
+		DESIGNTABLE_SCHEMA.check(designtable)
 
 		self.filename = designtable["filename"]
 		self.path = join(backend_root,collname,self.filename)
@@ -64,38 +73,161 @@ class DesignTable(BaseElement):
 		for cl in designtable["classes"]:
 			self.classes.append(DesignTableClass(cl))
 
+	def iter_rows(self,classes):
+		"""
+		Yields the header and then a row for every common combination of
+		classes, a list of DesignTableClass and BOLTSClass tuples
+		"""
+		columns = sorted(self.params)
+		metadata = sorted(self.metadata)
+		yield [""] + columns + metadata
+		for dtcl, cl in classes:
+			params = cl.parameters
+			if params.common is None:
+				continue
+			naming = cl.naming if dtcl.naming is None else dtcl.naming
+			for combination in params.common:
+				values = params.collect(dict(zip(params.free,combination)))
+				values.setdefault("standard",cl.name)
+				row = [naming.get_name(values)]
+				row += [values[self.params[column]] for column in columns]
+				row += [values[self.metadata[key]] for key in metadata]
+				yield row
+
 class SolidWorksData(DataBase):
-	def __init__(self,path):
-		DataBase.__init__(self,"solidworks",path)
+	def __init__(self,path,errors=None,documents=None):
+		DataBase.__init__(self,"solidworks",path,errors,documents)
 		self.designtables = []
 
 		if not exists(path):
 			e = MalformedRepositoryError("Repo directory does not exist")
 			e.set_repo_path(path)
-			raise e
+			self._report(e)
+			return
 		if not exists(join(self.backend_root)):
 			e = MalformedRepositoryError("solidworks directory does not exist")
 			e.set_repo_path(path)
-			raise e
+			self._report(e)
+			return
 
 		for coll in listdir(self.backend_root):
 			basefilename = join(self.backend_root,coll,"%s.base" % coll)
 			if not exists(basefilename):
 				#skip directory that is no collection
 				continue
-			base =  list(yaml.load_all(open(basefilename,"r","utf8")))
-			if len(base) != 1:
-				raise MalformedCollectionError(
-						"No YAML document found in file %s" % basefilename)
-			base = base[0]
+			try:
+				base = load_document(basefilename,self.documents)
+			except ParsingError as e:
+				e.set_collection(coll)
+				self._report(e)
+				continue
 
 			for designtable in base:
-				if not designtable["type"] == "solidworks":
-					continue
-				self.designtables.append(DesignTable(designtable,coll,self.backend_root))
-
-
-
-
-
+				try:
+					if not designtable["type"] == "solidworks":
+						continue
+					self.designtables.append(DesignTable(designtable,coll,self.backend_root))
+				except ParsingError as e:
+					e.set_base(designtable.get("filename"))
+					e.set_collection(coll)
+					self._report(e)
+				except (ValueError,KeyError) as e:
+					self._report_unexpected(e,coll,designtable)
+
+#increase when the generated output changes
+EXPORT_VERSION = 2
+MANIFEST_NAME = ".manifest"
+
+def write_xls(rows,filename):
+	"Writes rows to a xls design table, one row at a time"
+	if xlwt is None:
+		raise ImportError("xlwt is needed to write design tables")
+	workbook = xlwt.Workbook("utf8")
+	sheet = workbook.add_sheet("Sheet1")
+	for i, row in enumerate(rows):
+		for j, value in enumerate(row):
+			sheet.write(i,j,value)
+	workbook.save(filename)
+
+def _write_table(job):
+	#entry point for the worker processes
+	designtable, classes, filename, writer = job
+	writer(designtable.iter_rows(classes),filename)
+
+class SolidWorksExporter:
+	"""
+	Writes the design tables of the SolidWorks backend for a repository,
+	in parallel if processes is given. A manifest in the output directory
+	lets later runs skip design tables whose inputs did not change. writer
+	is called with the rows and the file name of each design table.
+	"""
+	def __init__(self,repo,data,processes=None,writer=write_xls):
+		self.repo = repo
+		self.data = data
+		self.processes = processes
+		self.writer = writer
+		#relative paths of the design tables written in the last run
+		self.written = []
+
+	def _get_stamp(self,designtable,classes):
+		#stamp of all inputs of a design table
+		stamp = hashlib.sha1("%d %s" % (EXPORT_VERSION,self.writer.__name__))
+		basefile = join(self.data.backend_root,designtable.collection,
+			"%s.base" % designtable.collection)
+		stamp.update(file_stamp(read_file(basefile)))
+		if exists(designtable.path):
+			stamp.update(file_stamp(read_file(designtable.path)))
+		for dtcl, cl in classes:
+			stamp.update(self.repo.get_stamp(self.repo.get_collection_of(cl.id).id))
+		return stamp.hexdigest()
+
+	def write_output(self,out_path):
+		"Writes the design tables to out_path, returns their relative paths"
+		if not exists(out_path):
+			os.makedirs(out_path)
+		manifest_name = join(out_path,MANIFEST_NAME)
+		#relative path of design table to stamp and relative path of model
+		manifest = load_manifest(manifest_name,EXPORT_VERSION,{})
+		stamps = {}
+		self.written = []
+
+		jobs = []
+		for designtable in self.data.designtables:
+			classes = [(dtcl,self.repo.get_class_by_id(dtcl.classid))
+				for dtcl in designtable.classes if dtcl.classid in self.repo.classids]
+			rel = join(designtable.collection,designtable.outname)
+			filename = join(out_path,rel)
+			model = join(designtable.collection,designtable.filename)
+			stamps[rel] = (self._get_stamp(designtable,classes),model)
+			if manifest.get(rel) == stamps[rel] and exists(filename):
+				continue
+			if not exists(join(out_path,designtable.collection)):
+				os.makedirs(join(out_path,designtable.collection))
+			#the model the design table belongs to
+			if exists(designtable.path):
+				copyfile(designtable.path,join(out_path,model))
+			jobs.append((designtable,classes,filename,self.writer))
+			self.written.append(rel)
+
+		if self.processes is None or self.processes < 2 or len(jobs) < 2:
+			for job in jobs:
+				_write_table(job)
+		else:
+			pool = Pool(min(self.processes,len(jobs)))
+			try:
+				pool.map(_write_table,jobs)
+			finally:
+				pool.close()
+				pool.join()
+
+		#remove outputs that are no longer produced
+		models = set(model for stamp, model in stamps.values())
+		for rel, (stamp, model) in manifest.iteritems():
+			if rel in stamps:
+				continue
+			for old in [rel,model]:
+				if (old == rel or not old in models) and exists(join(out_path,old)):
+					os.remove(join(out_path,old))
 
+		save_manifest(manifest_name,EXPORT_VERSION,stamps)
+		return sorted(stamps)
@@ -15,17 +15,38 @@
 #License along with this library; if not, write to the Free Software
 #Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
-import blt, openscad, freecad, drawings, solidworks
-import yaml
+import blt, common, cache, openscad, freecad, drawings, solidworks, loader
+import valueindex, search, validation
+import os
 import unittest
+from tempfile import mkdtemp
+from shutil import rmtree, copytree, copyfile
+from os.path import join, exists
+from copy import deepcopy
+import cPickle as pickle
 # pylint: disable=W0622
 from codecs import open
 from errors import *
+from loader import load_document
 
 def load_coll(filename):
-	coll = list(yaml.load_all(open(filename,"r","utf8")))
-	return coll[0]
+	return load_document(filename)
 
+def replace_in_file(filename,old,new,count=-1):
+	content = open(filename).read()
+	with open(filename,"w") as fid:
+		fid.write(content.replace(old,new,count))
+
+
+class RepositoryTestCase(unittest.TestCase):
+	"Provides a copy of the test repository in a temporary directory"
+	def setUp(self):
+		self.tmpdir = mkdtemp()
+		self.repo_path = join(self.tmpdir,"repo")
+		copytree("test/syntax",self.repo_path)
+
+	def tearDown(self):
+		rmtree(self.tmpdir)
 
 class TestCollectionLoad(unittest.TestCase):
 	def test_wrong_version(self):
@@ -98,6 +119,98 @@ class TestCollectionLoad(unittest.TestCase):
 		self.assertEqual(len(p.common),10)
 
 
+	def test_lazy(self):
+		coll = blt.BOLTSCollection(load_coll("test/data/type_error1.blt"),lazy=True)
+		cl = coll.classes[0]
+		self.assertEqual(cl.naming.template,"Partname")
+		self.assertRaises(UnknownParameterError, lambda: cl.parameters)
+		self.assertRaises(UnknownParameterError, lambda: coll.validate())
+
+		coll = blt.BOLTSCollection(load_coll("test/data/parameters.blt"),lazy=True)
+		params = coll.classes[0].parameters.collect({'key' : 'M2.5', 'l' : 37.4})
+		self.assertEqual(params['s'],12.0)
+
+	def test_shared_aliases(self):
+		doc = deepcopy(load_coll("test/data/replacing.blt"))
+		doc["classes"][0]["standard"] = ["ISO4017","EN24017"]
+		for lazy in [False, True]:
+			iso, en = blt.BOLTSCollection(doc,lazy).classes
+			self.assertEqual((iso.name,en.name),("ISO4017","EN24017"))
+			self.assertEqual(en.openscadname,"EN24017")
+			self.assertTrue(iso.parameters is en.parameters)
+			self.assertTrue(iso.naming is en.naming)
+
+	def test_collect_record(self):
+		p = blt.BOLTSCollection(load_coll("test/data/table2d.blt")).classes[0].parameters
+		free = {"key" : "M2.5", "thread_type" : "fine I"}
+		rec = p.collect_record(free)
+		self.assertEqual(rec,p.collect(free))
+		self.assertEqual(rec["pitch_name"],"x0.35")
+		self.assertEqual(rec.as_dict()["d2"],9.0)
+		def assign():
+			rec["d2"] = 1.0
+		self.assertRaises(TypeError, assign)
+
+		#modifying a result must not affect later results
+		res = p.collect(free)
+		res["d1"] = 0
+		self.assertEqual(p.collect(free)["d1"],2.5)
+
+		self.assertRaises(ValueError, lambda: p.collect({"key" : "M2.5", "thread_type" : "medium"}))
+		self.assertRaises(KeyError, lambda: p.collect({"key" : "M2.5"}))
+
+		#the compiled plan is not stored
+		self.assertEqual(pickle.loads(pickle.dumps(p,2)).collect(free),p.collect(free))
+
+	def test_collect_many(self):
+		p = blt.BOLTSCollection(load_coll("test/data/table2d.blt")).classes[0].parameters
+		free = [{"key" : key, "thread_type" : tt} for key, tt in p.common]
+		res = p.collect_many(free)
+		for i,values in enumerate(free):
+			single = p.collect(values)
+			for pname in p.parameters:
+				self.assertEqual(res[pname][i],single[pname])
+
+		columns = {"key" : ["M2.5","M1.6"], "thread_type" : ["fine I","fine I"]}
+		res = p.collect_many(columns)
+		self.assertEqual(res["pitch_name"],["x0.35","x0.2"])
+		self.assertEqual(res["d1"],[2.5,2.2])
+
+		self.assertEqual(p.collect_many([])["d1"],[])
+		self.assertRaises(ValueError, lambda: p.collect_many({"key" : ["M1.6"], "thread_type" : []}))
+		self.assertRaises(KeyError, lambda: p.collect_many({"key" : ["M1.6"]}))
+		#same errors as collect for an unknown column of a 2D table
+		self.assertRaises(ValueError, lambda: p.collect_many([{"key" : "M1.6", "thread_type" : "fine"}]))
+		self.assertEqual(p.collect_many([free[0]])["pitch_name"],[p.collect(free[0])["pitch_name"]])
+
+	def test_common(self):
+		p = blt.BOLTSCollection(load_coll("test/data/table2d.blt")).classes[0].parameters
+		combinations = list(p.common)
+		self.assertEqual(combinations[0],["M1.6","coarse"])
+		self.assertEqual(combinations,[p.common[i] for i in range(len(p.common))])
+		self.assertEqual(p.common[-1],combinations[-1])
+		self.assertEqual(p.common.index(["M2.5","fine I"]),combinations.index(["M2.5","fine I"]))
+		self.assertRaises(IndexError, lambda: p.common[10])
+		self.assertEqual(p.common[0:2],combinations[0:2])
+		self.assertEqual(p.common[::-3],combinations[::-3])
+		self.assertRaises(TypeError, lambda: p.common["0"])
+
+		p = common.BOLTSParameters({
+			"free" : ["key","detailed"],
+			"types" : {"key" : "Table Index", "detailed" : "Bool"},
+			"tables" : {"index" : "key", "columns" : ["d"],
+				"data" : {"M2" : [2], "M3" : [3], "M4" : [4]}},
+			"common" : [[":",[True]],[["M4"],":"]]
+		})
+		self.assertEqual(len(p.common),5)
+		self.assertEqual(list(p.common),[["M2",True],["M3",True],["M4",True],["M4",True],["M4",False]])
+		self.assertEqual(p.common[4],["M4",False])
+		self.assertEqual(p.common.index(["M4",True]),2)
+		self.assertFalse(["M2",False] in p.common)
+
+		p = common.BOLTSParameters({})
+		self.assertEqual(list(p.common),[[]])
+
 	def test_table_error(self):
 		#negative value for parameter of type length
 		self.assertRaises(ValueError, lambda:
@@ -112,6 +225,16 @@ class TestCollectionLoad(unittest.TestCase):
 		cls = coll.classes
 
 		union = cls[0].parameters.union(cls[1].parameters)
+		self.assertEqual(union.free,["key","l"])
+		self.assertEqual(union.choices["key"],["M1.6","M2.5"])
+		self.assertEqual(set(union.parameters),set(cls[0].parameters.parameters))
+		union = common.union_parameters(cls[0].parameters,cls[1].parameters,
+			common.BOLTSParameters({
+				"free" : ["key"],
+				"types" : {"key" : "Table Index"},
+				"tables" : {"index" : "key", "columns" : [], "data" : {"M2.5" : []}}
+			}))
+		self.assertEqual(union.choices["key"],["M2.5"])
 		self.assertRaises(IncompatibleTypeError, lambda:
 			cls[0].parameters.union(cls[2].parameters))
 		self.assertRaises(IncompatibleDefaultError, lambda:
@@ -119,6 +242,15 @@ class TestCollectionLoad(unittest.TestCase):
 		self.assertRaises(IncompatibleDescriptionError, lambda:
 			cls[0].parameters.union(cls[4].parameters))
 
+	def test_choice_order(self):
+		choices = ["M10x1.25","M8","M10","M10x1","1-1/2-6","3/8-16","1/4-20","M1.6"]
+		self.assertEqual(common.sort_choices(choices),
+			["1/4-20","3/8-16","1-1/2-6","M1.6","M8","M10","M10x1","M10x1.25"])
+		self.assertTrue(common.natural_key("M10") is common.natural_key("M10"))
+		#the memoized keys are bounded
+		common.sort_choices(["M%d" % i for i in range(common.NATURAL_KEYS.maxsize + 10)])
+		self.assertEqual(len(common.NATURAL_KEYS),common.NATURAL_KEYS.maxsize)
+
 	
 
 class TestBOLTSRepository(unittest.TestCase):
@@ -147,13 +279,560 @@ class TestBOLTSRepository(unittest.TestCase):
 				self.assertTrue(cl.parameters.choices["key"][0] == "M1.6")
 				self.assertTrue(cl.parameters.choices["key"][-1] == "M52")
 
-class TestOpenSCAD(unittest.TestCase):
+	def test_table_storage(self):
+		doc = load_document("test/syntax/data/multitable.blt")
+		repo = blt.BOLTSRepository("test/syntax")
+		table = repo.get_class_by_id("hexscrew1").parameters.tables[1]
+		self.assertEqual(table.data["M1.6"],[3.48,None])
+		self.assertEqual(table.data["M3"],[6.01,1.5])
+		self.assertEqual(len(table.data),len(table.data.keys()))
+		self.assertTrue("M52" in table.data)
+		self.assertFalse("M64" in table.data)
+		self.assertEqual(dict(table.data.items())["M4"],[7.66,2.1])
+		#the parsed document is not modified
+		self.assertEqual(doc["classes"][0]["parameters"]["tables"][1]["data"]["M1.6"],[3.48,"None"])
+
+		p = common.BOLTSParameters({
+			"free" : ["key"],
+			"types" : {"key" : "Table Index", "hollow" : "Bool", "name" : "String"},
+			"tables" : {"index" : "key", "columns" : ["hollow","name"],
+				"data" : {"a" : ["True","first"], "b" : ["False","None"]}}
+		})
+		self.assertEqual(p.collect({"key" : "a"}),{"key" : "a", "hollow" : True, "name" : "first"})
+		self.assertEqual(p.collect({"key" : "b"}),{"key" : "b", "hollow" : False, "name" : None})
+
+	def test_value_lookup(self):
+		repo = blt.BOLTSRepository("test/syntax")
+		p = repo.get_class_by_id("hexscrew1").parameters
+		self.assertEqual(p.lookup_ceiling("d1",7.5),"M8")
+		self.assertEqual(p.lookup_ceiling("d1",8),"M8")
+		self.assertEqual(p.lookup_floor("d1",7.5),"M7")
+		self.assertEqual(p.lookup_floor("d1",1.0),None)
+		self.assertEqual(p.lookup_nearest("d1",7.4),"M7")
+		self.assertEqual(p.lookup_nearest("d1",7.6),"M8")
+		self.assertEqual(p.lookup_nearest("d1",100),"M52")
+		#M64 is not a valid choice, as it is missing from the second table
+		self.assertEqual(p.lookup_ceiling("d1",53),None)
+		self.assertEqual(p.lookup_range("s",10,13),["M6","M7","M8"])
+		self.assertEqual(p.lookup_range("h",None,2.2),["M3","M4"])
+		self.assertEqual(p.lookup_range("h",15),[])
+		self.assertRaises(KeyError, lambda: p.lookup_floor("l",10))
+
+	def test_lookup(self):
+		repo = blt.BOLTSRepository("test/syntax")
+		cl = repo.get_class_by_id("hexscrew1")
+		self.assertEqual(cl.name,"DIN933")
+		self.assertTrue(repo.get_class_by_name("DIN933") is cl)
+		self.assertEqual(repo.get_classes_by_body("DIN"),[cl])
+		self.assertEqual(repo.get_collection_of("hexscrew1").id,"multitable")
+		self.assertTrue(repo.get_collection("multitable") is repo.collections[0])
+		self.assertRaises(KeyError, lambda: repo.get_class_by_id("hexscrew2"))
+
+class TestSchema(unittest.TestCase):
+	def test_check(self):
+		schema = common.Schema("naming",["template"],["substitute"])
+		schema.check({"template" : "%s", "substitute" : ["key"]})
+		self.assertRaises(UnknownFieldError, lambda: schema.check({"template" : "", "foo" : 1}))
+		self.assertRaises(MissingFieldError, lambda: schema.check({"substitute" : []}))
+		#a schema can be checked many times
+		schema.check({"template" : "%s"})
+
+		mandatory = ["template"]
+		common.check_schema({"template" : ""},"naming",mandatory,[])
+		self.assertEqual(mandatory,["template"])
+
+	def test_trusted(self):
+		schema = common.Schema("naming",["template"],[])
+		schema.check({"foo" : 1},trusted=True)
+		self.assertRaises(UnknownFieldError, lambda: schema.check({"foo" : 1}))
+
+		repo = blt.BOLTSRepository("test/syntax",trusted=True)
+		self.assertEqual(repo.classids,set(["hexscrew1"]))
+
+		#lazily built parameters are trusted as well
+		coll = load_coll("test/data/parameters.blt")
+		coll["classes"][0]["parameters"]["foo"] = 1
+		cl = blt.BOLTSCollection(coll,lazy=True,trusted=True).classes[0]
+		self.assertEqual(cl.parameters.free,["key","l"])
+
+class TestLoader(unittest.TestCase):
+	def test_document_count(self):
+		self.assertRaises(MalformedCollectionError, lambda:
+			loader.parse_document("---\na: 1\n---\nb: 2\n","two.blt")
+		)
+		self.assertRaises(MalformedCollectionError, lambda:
+			loader.parse_document("#only a comment\n","none.blt")
+		)
+		self.assertEqual(loader.parse_document("---\na: 1\n...\n","one.blt"),{"a" : 1})
+
+	def test_shared_cache(self):
+		cache = loader.DocumentCache()
+		first = cache.load("test/data/parameters.blt")
+		second = cache.load("test/data/parameters.blt")
+		self.assertTrue(first is second)
+		self.assertEqual((cache.hits,cache.misses),(1,1))
+
+		#building must not modify the shared document
+		blt.BOLTSCollection(first)
+		self.assertEqual(first["classes"][0]["parameters"]["types"],{"key" : "Table Index"})
+
+		#sharing is opt-in
+		self.assertFalse(load_document("test/data/parameters.blt") is first)
+		cache = loader.DocumentCache()
+		blt.BOLTSRepository("test/syntax",documents=cache)
+		openscad.OpenSCADData("test/syntax",documents=cache)
+		self.assertEqual(cache.misses,len(cache.documents))
+		self.assertTrue(any(key.endswith("multitable.blt") for key in cache.documents))
+		self.assertTrue(any(key.endswith("hex.base") for key in cache.documents))
+
+class TestRepositoryCache(RepositoryTestCase):
+	def setUp(self):
+		RepositoryTestCase.setUp(self)
+		self.cachefile = join(self.tmpdir,"repo.cache")
+
+	def test_warm_start(self):
+		cold = blt.BOLTSRepository("test/syntax",cachefile=self.cachefile)
+		self.assertTrue(exists(self.cachefile))
+
+		#a warm start must not build any collection
+		load_collection = blt._load_collection
+		def fail(*args):
+			raise AssertionError("collection was rebuilt")
+		blt._load_collection = fail
+		try:
+			warm = blt.BOLTSRepository("test/syntax",cachefile=self.cachefile)
+		finally:
+			blt._load_collection = load_collection
+
+		self.assertEqual([c.id for c in warm.collections],[c.id for c in cold.collections])
+		cl = warm.collections[0].classes[0]
+		self.assertEqual(cl.standard_body,"DIN")
+		self.assertEqual(cl.parameters.choices["key"][0],"M1.6")
+
+	def test_changed_file(self):
+		blt.BOLTSRepository(self.repo_path,cachefile=self.cachefile)
+
+		replace_in_file(join(self.repo_path,"data","multitable.blt"),"hexagon head screw","changed screw")
+
+		repo = blt.BOLTSRepository(self.repo_path,cachefile=self.cachefile)
+		self.assertEqual(repo.collections[0].classes[0].description,"changed screw")
+
+	def test_trusted(self):
+		replace_in_file(join(self.repo_path,"data","multitable.blt"),"    - id: hexscrew1\n","    - id: hexscrew1\n      bogusfield: 1\n")
+
+		blt.BOLTSRepository(self.repo_path,cachefile=self.cachefile,trusted=True)
+		#unchecked collections from the cache are not used by untrusted loads
+		self.assertRaises(UnknownFieldError,
+			lambda: blt.BOLTSRepository(self.repo_path,cachefile=self.cachefile))
+
+	def test_changed_code(self):
+		blt.BOLTSRepository("test/syntax",cachefile=self.cachefile)
+		code_stamp = cache.CODE_STAMP
+		cache.CODE_STAMP = "changed"
+		try:
+			self.assertEqual(cache.CollectionCache(self.cachefile,blt.CURRENT_VERSION).entries,{})
+		finally:
+			cache.CODE_STAMP = code_stamp
+		self.assertNotEqual(cache.CollectionCache(self.cachefile,blt.CURRENT_VERSION).entries,{})
+
+class TestParallelLoading(RepositoryTestCase):
+	def setUp(self):
+		RepositoryTestCase.setUp(self)
+		copyfile("test/data/table2d.blt",join(self.repo_path,"data","table2d.blt"))
+		copyfile("test/data/minimal_class.blt",join(self.repo_path,"data","minimal_class.blt"))
+
+	def test_parallel(self):
+		serial = blt.BOLTSRepository(self.repo_path)
+		parallel = blt.BOLTSRepository(self.repo_path,processes=4)
+		self.assertEqual([c.id for c in parallel.collections],[c.id for c in serial.collections])
+		for body in serial.standardized:
+			self.assertEqual([cl.name for cl in parallel.standardized[body]],
+				[cl.name for cl in serial.standardized[body]])
+		for coll in parallel.collections:
+			if coll.id == "table2d":
+				res = coll.classes[0].parameters.collect({"key" : "M1.6", "thread_type" : "fine I"})
+				self.assertEqual(res["pitch_name"],"x0.2")
+
+	def test_lazy_validation(self):
+		copyfile("test/data/type_error1.blt",join(self.repo_path,"data","type_error1.blt"))
+		repo = blt.BOLTSRepository(self.repo_path,processes=4,lazy=True)
+		with self.assertRaises(UnknownParameterError) as cm:
+			repo.validate()
+		self.assertEqual(cm.exception.trace_info["Collection"],"type_error1.blt")
+		self.assertEqual(cm.exception.trace_info["Class"],"partname")
+
+	def test_error_trace(self):
+		copyfile("test/data/type_error1.blt",join(self.repo_path,"data","type_error1.blt"))
+		with self.assertRaises(UnknownParameterError) as cm:
+			blt.BOLTSRepository(self.repo_path,processes=4)
+		self.assertEqual(cm.exception.trace_info["Collection"],"type_error1.blt")
+		self.assertEqual(cm.exception.trace_info["Repository path"],self.repo_path)
+
+class TestReload(RepositoryTestCase):
+	def setUp(self):
+		RepositoryTestCase.setUp(self)
+		copyfile("test/data/table2d.blt",join(self.repo_path,"data","table2d.blt"))
+		self.repo = blt.BOLTSRepository(self.repo_path)
+
+	def test_unchanged(self):
+		self.assertTrue(self.repo.reload().is_empty())
+
+	def test_changed(self):
+		replace_in_file(join(self.repo_path,"data","table2d.blt"),"Screw with pitch","Bolt with pitch")
+
+		old_din933 = self.repo.standardized["DIN"][0]
+		changes = self.repo.reload()
+		self.assertEqual(changes.changed_collections,["table2d"])
+		self.assertEqual(changes.changed_classes,set(["screw"]))
+		self.assertEqual(changes.get_affected_classes(),set(["screw"]))
+		#untouched collections are not rebuilt
+		self.assertTrue(self.repo.standardized["DIN"][0] is old_din933)
+
+	def test_changed_class(self):
+		filename = join(self.repo_path,"data","parameters.blt")
+		copyfile("test/data/parameter_union.blt",filename)
+		self.repo.reload()
+		content = open(filename).read()
+		head, tail = content.split("id: partnametype")
+		with open(filename,"w") as fid:
+			fid.write(head + "id: partnametype" + tail.replace("template: Partname","template: Part",1))
+
+		changes = self.repo.reload()
+		self.assertEqual(changes.changed_collections,["parameters"])
+		self.assertEqual(changes.get_affected_classes(),set(["partnametype"]))
+
+	def test_missing_replaced(self):
+		filename = join(self.repo_path,"data","table2d.blt")
+		stamp = self.repo.get_stamp("table2d")
+		replace_in_file(filename,"    naming:","    standard: ISO9998\n    replaces: DIN9999\n    naming:",1)
+
+		self.assertRaises(ValueError,self.repo.reload)
+		#nothing was changed
+		self.assertEqual(self.repo.get_class_by_id("screw").replaces,None)
+		self.assertEqual(self.repo.get_stamp("table2d"),stamp)
+		self.assertRaises(KeyError,lambda: self.repo.get_class_by_name("ISO9998"))
+
+	def test_obsolescence(self):
+		replacing = join(self.repo_path,"data","replacing.blt")
+		copyfile("test/data/replacing.blt",replacing)
+		changes = self.repo.reload()
+		self.assertEqual(changes.added_collections,["replacing"])
+		self.assertEqual(changes.added_classes,set(["hexscrew2"]))
+		self.assertEqual(changes.changed_classes,set(["hexscrew1"]))
+		self.assertEqual(self.repo.standardized["DIN"][0].replacedby,"ISO4017")
+		self.assertEqual(self.repo.classids,set(["hexscrew1","hexscrew2","screw"]))
+
+		os.remove(replacing)
+		changes = self.repo.reload()
+		self.assertEqual(changes.removed_collections,["replacing"])
+		self.assertEqual(changes.removed_classes,set(["hexscrew2"]))
+		self.assertEqual(self.repo.standardized["DIN"][0].replacedby,None)
+		self.assertEqual(self.repo.standardized["ISO"],[])
+		self.assertRaises(KeyError, lambda: self.repo.get_class_by_name("ISO4017"))
+		self.assertRaises(KeyError, lambda: self.repo.get_collection("replacing"))
+
+class TestCollectCache(RepositoryTestCase):
+	def test_lru(self):
+		lru = cache.LRUCache(2)
+		lru.put(("a",1),1)
+		lru.put(("a",2),2)
+		self.assertEqual(lru.get(("a",1)),1)
+		lru.put(("b",1),3)
+		self.assertFalse(("a",2) in lru)
+		self.assertEqual((lru.hits,lru.misses,lru.evictions),(1,0,1))
+		lru.invalidate(["a"])
+		self.assertEqual(len(lru),1)
+
+	def test_collect(self):
+		p = blt.BOLTSCollection(load_coll("test/data/parameters.blt")).classes[0].parameters
+		lru = cache.LRUCache(10)
+		p.set_cache(lru,"partname")
+		first = p.collect({"key" : "M2.5", "l" : 37})
+		first["s"] = 0
+		second = p.collect_record({"key" : "M2.5", "l" : 37})
+		self.assertEqual((lru.hits,lru.misses),(1,1))
+		self.assertEqual(second["s"],12.0)
+		#values are the same as without a cache
+		self.assertTrue(isinstance(second["l"],int))
+		self.assertTrue(isinstance(p.collect({"key" : "M2.5", "l" : 37.0})["l"],float))
+		self.assertEqual(p.collect({"key" : "M2.5", "l" : [37]})["l"],[37])
+
+	def test_plan(self):
+		repo = blt.BOLTSRepository("test/syntax")
+		params = repo.get_class_by_id("hexscrew1").parameters
+		self.assertEqual(params.collect({"key" : "M1.6", "l" : 10})["h"],None)
+		self.assertEqual(params.collect({"key" : "M3", "l" : 10})["h"],1.5)
+		self.assertRaises(KeyError,lambda: params.collect({"key" : "M1", "l" : 10}))
+
+		p = blt.BOLTSCollection(load_coll("test/data/table2d.blt")).classes[0].parameters
+		self.assertEqual(p.collect({"key" : "M2.5", "thread_type" : "fine I"})["pitch_name"],"x0.35")
+		self.assertRaises(ValueError,lambda: p.collect({"key" : "M2.5", "thread_type" : "fine"}))
+
+	def test_naming(self):
+		naming = common.BOLTSNaming({"template" : "Part %s", "substitute" : ["l"]})
+		naming.set_cache(cache.LRUCache(10),"part")
+		self.assertEqual(naming.get_name({"l" : 37}),"Part 37")
+		self.assertEqual(naming.get_name({"l" : 37.0}),"Part 37.0")
+		self.assertEqual(naming.get_name({"l" : [37]}),"Part [37]")
+
+	def test_repository(self):
+		copyfile("test/data/table2d.blt",join(self.repo_path,"data","table2d.blt"))
+		repo = blt.BOLTSRepository(self.repo_path,lazy=True)
+		lru = cache.LRUCache(10)
+		repo.set_collect_cache(lru)
+
+		hexscrew = repo.get_class_by_id("hexscrew1")
+		screw = repo.get_class_by_id("screw")
+		params = hexscrew.parameters.collect({"key" : "M3", "l" : 10})
+		self.assertEqual(hexscrew.naming.get_name(dict(params,standard="DIN933")),
+			"Hexagon head screw DIN933 - M3 10")
+		screw.parameters.collect({"key" : "M1.6", "thread_type" : "coarse"})
+		self.assertEqual(len(lru),3)
+
+		replace_in_file(join(self.repo_path,"data","table2d.blt"),"x0.35","x0.36")
+		repo.reload()
+		self.assertEqual([key[0] for key in lru.entries],["hexscrew1","hexscrew1"])
+
+		screw = repo.get_class_by_id("screw")
+		res = screw.parameters.collect({"key" : "M2.5", "thread_type" : "fine I"})
+		self.assertEqual(res["pitch_name"],"x0.36")
+		self.assertEqual(len(lru),3)
+
+class TestValueIndex(RepositoryTestCase):
+	def setUp(self):
+		RepositoryTestCase.setUp(self)
+		copyfile("test/data/table2d.blt",join(self.repo_path,"data","table2d.blt"))
+		self.repo = blt.BOLTSRepository(self.repo_path)
+
+	def test_query(self):
+		index = valueindex.ValueIndex()
+		self.assertEqual(sorted(index.update(self.repo)),["multitable","table2d"])
+		self.assertEqual(index.update(self.repo),[])
+
+		self.assertEqual(index.lookup("key","M2.5"),set([("hexscrew1","M2.5"),("screw","M2.5")]))
+		self.assertEqual(index.lookup("d1",5),set([("hexscrew1","M5")]))
+		self.assertEqual(index.query({"key" : "M1.6", "pitch_name" : "x0.2"}),
+			set([("screw",("M1.6","fine I"))]))
+		self.assertEqual(index.lookup("thread_type","fine I"),
+			set([("screw",("M1.6","fine I")),("screw",("M2.5","fine I"))]))
+		self.assertEqual(index.query({"thread_type" : "fine I", "pitch_name" : "x0.35"}),
+			set([("screw",("M2.5","fine I"))]))
+		self.assertEqual(index.query({"d1" : 2.5, "pitch_name" : "x0.35"}),
+			set([("screw",("M2.5","fine I"))]))
+		self.assertEqual(index.query({"key" : "M8", "d1" : 5.0}),set())
+		self.assertEqual(index.query_classes({"key" : "M8", "d1" : 5.0}),set(["hexscrew1"]))
+
+	def test_literal(self):
+		filename = join(self.repo_path,"data","table2d.blt")
+		replace_in_file(filename,"      free: [key,thread_type]\n",
+			"      free: [key,thread_type]\n      literal: {material: steel}\n")
+		replace_in_file(filename,"        pitch_name: String\n","        pitch_name: String\n        material: String\n")
+		self.repo.reload()
+		index = valueindex.ValueIndex()
+		index.update(self.repo)
+
+		#literals match every row of the class
+		self.assertEqual(index.query({"material" : "steel"}),set([("screw",None)]))
+		self.assertEqual(index.query({"material" : "steel", "key" : "M2.5"}),set([("screw","M2.5")]))
+		self.assertEqual(index.query({"material" : "steel", "pitch_name" : "x0.2"}),
+			set([("screw",("M1.6","fine I"))]))
+
+	def test_incremental(self):
+		index = valueindex.ValueIndex()
+		index.update(self.repo)
+		filename = join(self.tmpdir,"index.pkl")
+		index.save(filename)
+
+		os.remove(join(self.repo_path,"data","table2d.blt"))
+		self.repo.reload()
+		loaded = valueindex.load_index(filename)
+		self.assertEqual(loaded.lookup("key","M2.5"),set([("hexscrew1","M2.5"),("screw","M2.5")]))
+		self.assertEqual(loaded.update(self.repo),[])
+		self.assertEqual(loaded.lookup("key","M2.5"),set([("hexscrew1","M2.5")]))
+		self.assertEqual(loaded.lookup("pitch_name","x0.2"),set())
+
+class TestSearchIndex(RepositoryTestCase):
+	def test_tokenize(self):
+		for query in ["DIN912","DIN 912","din-912"]:
+			self.assertEqual(search.tokenize(query),["din912"])
+		self.assertEqual(search.tokenize("DIN EN ISO 4017 M1.6"),["dineniso4017","m1.6"])
+		self.assertEqual(search.tokenize("EN ISO 4017"),["eniso4017"])
+
+	def test_search(self):
+		repo = blt.BOLTSRepository("test/syntax")
+		index = search.SearchIndex(repo)
+		cl = repo.get_class_by_id("hexscrew1")
+		self.assertEqual(index.search("din 933"),[cl])
+		self.assertEqual(index.search("DIN9"),[cl])
+		self.assertEqual(index.search("hexagon HEAD"),[cl])
+		self.assertEqual(index.search("hexagon nut"),[])
+		self.assertEqual(index.search(""),[])
+
+	def test_compound_standard(self):
+		content = open("test/data/replacing.blt").read()
+		with open(join(self.repo_path,"data","replacing.blt"),"w") as fid:
+			fid.write(content.replace("standard: ISO4017","standard: DINENISO4017"))
+		repo = blt.BOLTSRepository(self.repo_path)
+		index = search.SearchIndex(repo)
+		cl = repo.get_class_by_id("hexscrew2")
+		for query in ["DIN EN ISO 4017","EN ISO 4017","ISO 4017","iso40"]:
+			self.assertEqual(index.search(query),[cl])
+
+class TestValidation(RepositoryTestCase):
+	def test_valid(self):
+		report = validation.validate_repository(self.repo_path)
+		self.assertTrue(report.is_valid())
+
+	def test_collect_all(self):
+		for name in ["type_error1","wrong_version","replacing"]:
+			copyfile("test/data/%s.blt" % name,join(self.repo_path,"data","%s.blt" % name))
+		copyfile("test/syntax/data/multitable.blt",join(self.repo_path,"data","copy.blt"))
+		replace_in_file(join(self.repo_path,"openscad","hex","hex.base"),"classids: [hexbolt1, hexbolt2]","classid: [hexbolt1]")
+
+		report = validation.validate_repository(self.repo_path,processes=2)
+		self.assertEqual(len(report),4)
+		problems = report.get_problems()
+		self.assertEqual(sorted(p.get("Collection") for p in problems),
+			["copy.blt","hex","type_error1.blt","wrong_version.blt"])
+		self.assertTrue(all(p["Repository path"] == self.repo_path for p in problems))
+		self.assertEqual([p["Backend"] for p in problems if "Backend" in p],["openscad"])
+
+	def test_collect_unexpected(self):
+		#ValueErrors and KeyErrors do not stop the validation
+		copyfile("test/data/bad.blt",join(self.repo_path,"data","bad.blt"))
+		replace_in_file(join(self.repo_path,"openscad","hex","hex.base"),"type: module","kind: module")
+
+		problems = validation.validate_repository(self.repo_path).get_problems()
+		self.assertEqual(len(problems),4)
+		self.assertEqual(sorted(p.get("Class") for p in problems),
+			[None,"ISO9999","negative","unknownfield"])
+		self.assertTrue(problems[0]["Message"].startswith("ValueError: Negative length"))
+		self.assertTrue(problems[2]["Message"].startswith("KeyError"))
+		self.assertEqual(problems[2]["Backend"],"openscad")
+		self.assertEqual(problems[2]["Base"],"hex.scad")
+
+	def test_collection_errors(self):
+		errors = []
+		coll = load_coll("test/data/type_error1.blt")
+		collection = blt.BOLTSCollection(coll,errors=errors)
+		self.assertEqual(len(errors),1)
+		self.assertEqual(collection.classes,[])
+
+class TestOpenSCAD(RepositoryTestCase):
 	def test_syntax(self):
 		os = openscad.OpenSCADData("test/syntax")
 		self.assertTrue("hexscrew1" in os.getbase)
 		self.assertTrue("cube1" in os.getbase)
 		self.assertTrue("singlerowradialbearing" in os.getbase)
 
+	def test_parameters(self):
+		repo = blt.BOLTSRepository("test/syntax")
+		scad = openscad.OpenSCADData("test/syntax")
+		cl = repo.get_class_by_id("hexscrew1")
+		params = scad.get_parameters(cl)
+		self.assertTrue(params is scad.get_parameters(cl))
+		self.assertEqual(params.choices["key"],cl.parameters.choices["key"])
+
+	def test_export(self):
+		out_path = join(self.tmpdir,"out")
+		repo = blt.BOLTSRepository(self.repo_path)
+		exporter = openscad.OpenSCADExporter(repo,openscad.OpenSCADData(self.repo_path))
+		outputs = exporter.write_output(out_path)
+		self.assertEqual(outputs,["BOLTS.scad","base/multitable.scad",
+			"modules/multitable.scad","multitable.scad","tables/multitable.scad"])
+		self.assertEqual(sorted(exporter.written),outputs)
+		modules = open(join(out_path,"modules","multitable.scad")).read()
+		self.assertTrue("module DIN933(key=\"M1.6\", l=10){" in modules)
+
+		self.assertEqual(exporter.write_output(out_path),outputs)
+		self.assertEqual(exporter.written,[])
+		self.assertEqual(exporter.skipped,["multitable"])
+
+		#only outputs with changed content are written
+		replace_in_file(join(self.repo_path,"data","multitable.blt"),"M52:   [  52,   33,","M52:   [  52,   34,")
+		repo.reload()
+		exporter.write_output(out_path)
+		self.assertEqual(exporter.written,["tables/multitable.scad"])
+
+	def test_export_tables(self):
+		copyfile("test/data/table2d.blt",join(self.repo_path,"data","table2d.blt"))
+		os.mkdir(join(self.repo_path,"openscad","table2d"))
+		with open(join(self.repo_path,"openscad","table2d","table2d.base"),"w") as fid:
+			fid.write("\n".join(["---",
+				"- filename: table2d.scad",
+				"  author: John Doe <John@doe.org>",
+				"  license: MIT <http://opensource.org/licenses/MIT>",
+				"  type: module",
+				"  modules:",
+				"    - name: screw",
+				"      arguments: [pitch_name, s]",
+				"      classids: [screw]",
+				"..."]))
+		with open(join(self.repo_path,"openscad","table2d","table2d.scad"),"w") as fid:
+			fid.write("module screw(pitch_name, s){}\n")
+
+		repo = blt.BOLTSRepository(self.repo_path)
+		exporter = openscad.OpenSCADExporter(repo,openscad.OpenSCADData(self.repo_path))
+		exporter.write_output(join(self.tmpdir,"out"))
+		tables = open(join(self.tmpdir,"out","tables","table2d.scad")).read()
+		#only consumed columns are emitted
+		self.assertTrue("screw_s = [1.2, 12.0];" in tables)
+		self.assertFalse("screw_d1" in tables)
+		self.assertTrue('screw_thread_type_keys = ["coarse", "fine I",' in tables)
+		self.assertTrue('["", "x0.2", "", "", ""]' in tables)
+		modules = open(join(self.tmpdir,"out","modules","table2d.scad")).read()
+		self.assertTrue("screw(screw_pitch_name[key_pos][thread_type_pos], screw_s[key_pos]);" in modules)
+
+	def test_export_includes(self):
+		out_path = join(self.tmpdir,"out")
+		#a second collection sharing the base of the first
+		content = open(join(self.repo_path,"data","multitable.blt")).read()
+		with open(join(self.repo_path,"data","second.blt"),"w") as fid:
+			fid.write(content.replace("id: multitable","id: second").
+				replace("id: hexscrew1","id: hexscrew2").replace("DIN933","DIN934"))
+		replace_in_file(join(self.repo_path,"openscad","multitable","multitable.base"),"classids: [hexscrew1]","classids: [hexscrew1, hexscrew2]")
+		repo = blt.BOLTSRepository(self.repo_path)
+		data = openscad.OpenSCADData(self.repo_path)
+
+		openscad.OpenSCADExporter(repo,data).write_output(out_path)
+		library = open(join(out_path,"BOLTS.scad")).read()
+		self.assertEqual(library.count("include <base/multitable.scad>"),1)
+		wrapper = open(join(out_path,"second.scad")).read()
+		self.assertTrue("include <base/multitable.scad>" in wrapper)
+
+		exporter = openscad.OpenSCADExporter(repo,data,bundle=True)
+		outputs = exporter.write_output(out_path)
+		self.assertTrue("bundles/second.scad" in outputs)
+		self.assertFalse("tables/second.scad" in outputs)
+		#shared bases are not bundled
+		self.assertTrue("base/multitable.scad" in outputs)
+		bundle = open(join(out_path,"bundles","second.scad")).read()
+		self.assertFalse("module hex1" in bundle)
+		self.assertTrue("module DIN934" in bundle)
+
+		os.remove(join(self.repo_path,"data","second.blt"))
+		repo.reload()
+		outputs = exporter.write_output(out_path)
+		self.assertFalse("base/multitable.scad" in outputs)
+		bundle = open(join(out_path,"bundles","multitable.scad")).read()
+		self.assertTrue("module hex1" in bundle)
+		self.assertFalse(exists(join(out_path,"bundles","second.scad")))
+
+	def test_export_stl(self):
+		out_path = join(self.tmpdir,"out")
+		copyfile("test/data/stl.blt",join(self.repo_path,"data","stl.blt"))
+		repo = blt.BOLTSRepository(self.repo_path)
+		data = openscad.OpenSCADData(self.repo_path)
+
+		#import paths are resolved relative to the file containing the call
+		for bundle, rel in [(False,"modules"),(True,"bundles")]:
+			openscad.OpenSCADExporter(repo,data,bundle=bundle).write_output(out_path)
+			modules = open(join(out_path,rel,"stl.scad")).read()
+			self.assertTrue('import("../base/cube1.stl");' in modules)
+			self.assertTrue(exists(join(out_path,rel,"..","base","cube1.stl")))
+		#callers writing to the output root keep their paths
+		self.assertEqual(data.getbase["cube1"].get_incantation({}),'import("base/cube1.stl")')
+
 class TestFreeCAD(unittest.TestCase):
 	def test_syntax(self):
 		fc = freecad.FreeCADData("test/syntax")
@@ -161,14 +840,157 @@ class TestFreeCAD(unittest.TestCase):
 		self.assertFalse("lack1" in fc.getbase)
 		self.assertTrue("singlerowradialbearing" in fc.getbase)
 
-class TestDrawings(unittest.TestCase):
+class FakeShape:
+	#stand-in for a shape of the FreeCAD Part module
+	def __init__(self,brep=""):
+		self.brep = brep
+	def copy(self):
+		return FakeShape(self.brep)
+	def exportBrepToString(self):
+		return self.brep
+	def importBrepFromString(self,brep):
+		self.brep = brep
+
+class FakePart:
+	Shape = FakeShape
+
+class FakeObject:
+	def __init__(self,name):
+		self.Name = name
+		self.Shape = None
+
+class FakeDocument:
+	def __init__(self):
+		self.Objects = []
+	def addObject(self,type,name):
+		self.Objects.append(FakeObject(name))
+		return self.Objects[-1]
+
+class TestGeometryCache(RepositoryTestCase):
+	def setUp(self):
+		RepositoryTestCase.setUp(self)
+		self.shape_path = join(self.tmpdir,"shapes")
+		self.base = freecad.FreeCADData("test/syntax").getbase["hexscrew1"]
+		self.calls = 0
+
+	def build(self,params,document):
+		self.calls += 1
+		part = document.addObject("Part::Feature",params["name"])
+		part.Shape = FakeShape("%s %s" % (params["key"],params["l"]))
+
+	def test_memory(self):
+		geometry = freecad.GeometryCache(2,part=FakePart)
+		doc = FakeDocument()
+		params = {"key" : "M3", "l" : 20.0, "name" : "first"}
+		first = geometry.add_part("hexscrew1",self.base,self.build,params,doc)
+		params["name"] = "second"
+		second = geometry.add_part("hexscrew1",self.base,self.build,params,doc)
+		self.assertEqual(self.calls,1)
+		self.assertEqual((second.Name,second.Shape.brep),("second","M3 20.0"))
+		self.assertFalse(first.Shape is second.Shape)
+
+		geometry.add_part("hexscrew1",self.base,self.build,{"key" : "M4", "l" : 20.0, "name" : "a"},doc)
+		geometry.add_part("hexscrew1",self.base,self.build,{"key" : "M5", "l" : 20.0, "name" : "b"},doc)
+		self.assertEqual(geometry.shapes.evictions,1)
+		geometry.invalidate(["hexscrew1"])
+		self.assertEqual(len(geometry.shapes),0)
+
+	def test_disk(self):
+		params = {"key" : "M3", "l" : 20.0, "name" : "first"}
+		geometry = freecad.GeometryCache(path=self.shape_path,part=FakePart)
+		geometry.add_part("hexscrew1",self.base,self.build,params,FakeDocument())
+
+		geometry = freecad.GeometryCache(path=self.shape_path,part=FakePart)
+		part = geometry.add_part("hexscrew1",self.base,self.build,params,FakeDocument())
+		self.assertEqual(self.calls,1)
+		self.assertEqual(geometry.disk_hits,1)
+		self.assertEqual(part.Shape.brep,"M3 20.0")
+
+		geometry.invalidate(["hexscrew1"])
+		self.assertEqual(os.listdir(self.shape_path),[])
+
+class TestDrawings(RepositoryTestCase):
 	def test_syntax(self):
 		draw = drawings.DrawingsData("test/syntax")
 
-class TestSolidWorks(unittest.TestCase):
+	def test_index(self):
+		coll_path = join(self.repo_path,"drawings","multitable")
+		replace_in_file(join(coll_path,"multitable.base"),"filename: multitable.svg","filename: multitable")
+		with open(join(coll_path,"multitable.png"),"wb") as fid:
+			fid.write("\x89PNG\r\n\x1a\n\x00\x00\x00\x0dIHDR\x00\x00\x01\x2c\x00\x00\x00\xc8")
+		with open(join(coll_path,"multitable.svg"),"w") as fid:
+			fid.write('<?xml version="1.0"?>\n<svg xmlns="http://www.w3.org/2000/svg" width="210mm" height="297mm">\n</svg>\n')
+
+		data = drawings.DrawingsData(self.repo_path)
+		self.assertEqual(data.indexes.keys(),[coll_path])
+		draw = data.getbase["hexscrew1"]
+		self.assertEqual(draw.get_png(),join(coll_path,"multitable.png"))
+		self.assertEqual(draw.get_svg(),join(coll_path,"multitable.svg"))
+		metadata = draw.get_metadata("png")
+		self.assertEqual((metadata["width"],metadata["height"],metadata["size"]),(300,200,24))
+		self.assertTrue(draw.get_metadata("png") is metadata)
+		metadata = draw.get_metadata("svg")
+		self.assertEqual((metadata["width"],metadata["height"]),(210.0,297.0))
+		self.assertEqual(draw.get_metadata("pdf"),None)
+
+def write_rows(rows,filename):
+	#design table writer that does not need xlwt
+	with open(filename,"w") as fid:
+		for row in rows:
+			fid.write("%r\n" % (row,))
+
+class TestSolidWorks(RepositoryTestCase):
 	def test_syntax(self):
 		draw = solidworks.SolidWorksData("test/syntax")
 
+	def test_export(self):
+		out_path = join(self.tmpdir,"out")
+		filename = join(self.repo_path,"data","multitable.blt")
+		replace_in_file(filename,"free: [key, l]\n","free: [key, l]\n          common: [[\":\", [10, 20]]]\n")
+		os.mkdir(join(self.repo_path,"solidworks","multitable"))
+		with open(join(self.repo_path,"solidworks","multitable","multitable.base"),"w") as fid:
+			fid.write("\n".join(["---",
+				"- filename: hexscrew.sldprt",
+				"  author: John Doe <John@doe.org>",
+				"  license: MIT <http://opensource.org/licenses/MIT>",
+				"  type: solidworks",
+				"  suffix: DIN",
+				"  params: {Diameter@Sketch1: d1, Length@Boss: l}",
+				"  metadata: {$prp@Width: s}",
+				"  classes:",
+				"    - classid: hexscrew1",
+				"..."]))
+		model = join(self.repo_path,"solidworks","multitable","hexscrew.sldprt")
+		with open(model,"w") as fid:
+			fid.write("model")
+		repo = blt.BOLTSRepository(self.repo_path)
+		exporter = solidworks.SolidWorksExporter(repo,solidworks.SolidWorksData(self.repo_path),writer=write_rows)
+		outputs = exporter.write_output(out_path)
+		self.assertEqual(outputs,["multitable/hexscrew-DIN.xls","nuts/nut-ISO.xls"])
+		self.assertEqual(sorted(exporter.written),outputs)
+
+		rows = open(join(out_path,"multitable","hexscrew-DIN.xls")).read().splitlines()
+		self.assertEqual(len(rows),1 + 2*len(repo.get_class_by_id("hexscrew1").parameters.choices["key"]))
+		self.assertEqual(rows[0],repr(["","Diameter@Sketch1","Length@Boss","$prp@Width"]))
+		self.assertEqual(rows[1],repr(["Hexagon head screw DIN933 - M1.6 10",1.6,10,3.2]))
+
+		exporter.write_output(out_path)
+		self.assertEqual(exporter.written,[])
+
+		#a changed model is copied again
+		with open(model,"w") as fid:
+			fid.write("changed model")
+		exporter.write_output(out_path)
+		self.assertEqual(exporter.written,["multitable/hexscrew-DIN.xls"])
+		self.assertEqual(open(join(out_path,"multitable","hexscrew.sldprt")).read(),"changed model")
+
+		#outputs that are no longer produced are removed
+		rmtree(join(self.repo_path,"solidworks","multitable"))
+		exporter = solidworks.SolidWorksExporter(repo,solidworks.SolidWorksData(self.repo_path),writer=write_rows)
+		self.assertEqual(exporter.write_output(out_path),["nuts/nut-ISO.xls"])
+		self.assertFalse(exists(join(out_path,"multitable","hexscrew-DIN.xls")))
+		self.assertFalse(exists(join(out_path,"multitable","hexscrew.sldprt")))
+
 if __name__ == '__main__':
 	unittest.main()
 
@@ -0,0 +1,156 @@
+#bolttools - a framework for creation of part libraries
+#Copyright (C) 2013 Johannes Reinhardt <jreinhardt@ist-dein-freund.de>
+#
+#This library is free software; you can redistribute it and/or
+#modify it under the terms of the GNU Lesser General Public
+#License as published by the Free Software Foundation; either
+#version 2.1 of the License, or any later version.
+#
+#This library is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#Lesser General Public License for more details.
+#
+#You should have received a copy of the GNU Lesser General Public
+#License along with this library; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+#validation of a whole repository, reporting all problems at once
+
+from os import listdir
+from os.path import join, exists, splitext
+from multiprocessing import Pool
+
+from errors import *
+from blt import _load_collection, BOLTSRepository
+from cache import file_stamp
+from loader import read_file
+from openscad import OpenSCADData
+from freecad import FreeCADData
+from drawings import DrawingsData
+from solidworks import SolidWorksData
+
+BACKENDS = {
+	"openscad" : OpenSCADData,
+	"freecad" : FreeCADData,
+	"drawings" : DrawingsData,
+	"solidworks" : SolidWorksData
+}
+
+class ValidationReport:
+	"All problems found in a repository, as ParsingErrors with their trace_info"
+	def __init__(self,path):
+		self.path = path
+		self.errors = []
+
+	def is_valid(self):
+		return len(self.errors) == 0
+
+	def get_problems(self):
+		"Returns a dict with message and trace information for every problem"
+		problems = []
+		for e in self.errors:
+			problem = dict(e.trace_info)
+			problem["Message"] = e.msg
+			problems.append(problem)
+		return problems
+
+	def __len__(self):
+		return len(self.errors)
+
+	def __iter__(self):
+		return iter(self.errors)
+
+	def __str__(self):
+		return "\n".join(str(e) for e in self.errors)
+
+def _check(task):
+	#entry point for the worker processes, returns the class ids, the class
+	#names with the names they replace of a collection and the problems found
+	path, kind, name = task
+	errors = []
+	classids = []
+	names = []
+	try:
+		if kind == "collection":
+			data = read_file(join(path,"data",name))
+			coll = _load_collection(path,name,data,file_stamp(data),errors=errors)
+			if not coll is None:
+				classids = [cl.id for cl in coll.classes_by_ids()]
+				names = [(cl.name,cl.replaces) for cl in coll.classes]
+		else:
+			BACKENDS[name](path,errors)
+			for e in errors:
+				e.set_repo_path(path)
+				e.set_backend(name)
+	except Exception as exc:
+		#errors that are not ParsingErrors are reported as well
+		e = exc if isinstance(exc,ParsingError) else UnexpectedError(exc)
+		e.set_repo_path(path)
+		if kind == "collection":
+			e.set_collection(name)
+		else:
+			e.set_backend(name)
+		errors.append(e)
+	return classids, names, errors
+
+def validate_repository(path,processes=None):
+	"""
+	Checks all collections and all backends of the repository at path and
+	returns a ValidationReport, instead of stopping at the first problem
+	"""
+	report = ValidationReport(path)
+	if not exists(join(path,"data")):
+		e = MalformedRepositoryError("data directory does not exist")
+		e.set_repo_path(path)
+		report.errors.append(e)
+		return report
+
+	tasks = [(path,"collection",filename)
+		for filename in sorted(listdir(join(path,"data")))
+		if splitext(filename)[1] == ".blt"]
+	tasks += [(path,"backend",name) for name in sorted(BACKENDS)
+		if exists(join(path,name))]
+
+	if processes is None or processes < 2 or len(tasks) < 2:
+		results = [_check(task) for task in tasks]
+	else:
+		pool = Pool(min(processes,len(tasks)))
+		try:
+			results = pool.map(_check,tasks)
+		finally:
+			pool.close()
+			pool.join()
+
+	#class ids must be unique across collections
+	seen = {}
+	for task, (classids, names, errors) in zip(tasks,results):
+		report.errors.extend(errors)
+		for classid in classids:
+			if classid in seen:
+				e = NonUniqueClassIdError(classid)
+				e.set_repo_path(path)
+				e.set_collection(task[2])
+				report.errors.append(e)
+			else:
+				seen[classid] = task[2]
+
+	#replaced classes must exist as standardized classes in some collection
+	bodies = BOLTSRepository.standard_bodies
+	standardized = set()
+	for task, (classids, names, errors) in zip(tasks,results):
+		for name, replaces in names:
+			if any(name.startswith(body) for body in bodies):
+				standardized.add(name)
+	for task, (classids, names, errors) in zip(tasks,results):
+		for name, replaces in names:
+			if replaces is None or replaces in standardized:
+				continue
+			if not any(replaces.startswith(body) for body in bodies):
+				continue
+			e = MalformedCollectionError("Replaced class not found: %s" % replaces)
+			e.set_repo_path(path)
+			e.set_collection(task[2])
+			e.set_class(name)
+			report.errors.append(e)
+	return report
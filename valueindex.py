@@ -0,0 +1,204 @@
+#bolttools - a framework for creation of part libraries
+#Copyright (C) 2013 Johannes Reinhardt <jreinhardt@ist-dein-freund.de>
+#
+#This library is free software; you can redistribute it and/or
+#modify it under the terms of the GNU Lesser General Public
+#License as published by the Free Software Foundation; either
+#version 2.1 of the License, or any later version.
+#
+#This library is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#Lesser General Public License for more details.
+#
+#You should have received a copy of the GNU Lesser General Public
+#License along with this library; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+#index of parameter values over all classes of a repository
+
+import os
+import cPickle as pickle
+from os.path import exists
+
+from cache import CACHE_VERSION
+
+def normalize_value(value):
+	"Normalizes a parameter value for the index, numbers are compared as floats"
+	if isinstance(value,bool):
+		return value
+	if isinstance(value,(int,long,float)):
+		return float(value)
+	return value
+
+def _class_entries(cl):
+	#yields ((parameter name, value), key) for the class, where key is the
+	#table index value for tables, a tuple of row and column index values
+	#for 2D tables and None for literals
+	params = cl.parameters
+	for pname,value in params.literal.iteritems():
+		yield (pname,normalize_value(value)), None
+	for table in params.tables:
+		rows = table.data
+		for key in rows:
+			yield (table.index,normalize_value(key)), key
+			for i,col in enumerate(table.columns):
+				value = rows.get_value(key,i)
+				if not value is None:
+					yield (col,normalize_value(value)), key
+	for table in params.tables2d:
+		rows = table.data
+		for key in rows:
+			yield (table.rowindex,normalize_value(key)), key
+			for i,col in enumerate(table.columns):
+				yield (table.colindex,normalize_value(col)), (key,col)
+				value = rows.get_value(key,i)
+				if not value is None:
+					yield (table.result,normalize_value(value)), (key,col)
+
+def _matches(first,second):
+	#keys of a class that match both sets of keys. None matches every key,
+	#a table index value every column of a 2D table in this row
+	if None in first:
+		return second
+	if None in second:
+		return first
+	res = first & second
+	for keys, others in [(first,second),(second,first)]:
+		rows = {}
+		for other in others:
+			if isinstance(other,tuple):
+				rows.setdefault(other[0],[]).append(other)
+		for key in keys:
+			if not isinstance(key,tuple):
+				res.update(rows.get(key,()))
+	return res
+
+class ValueIndex:
+	"""
+	Inverted index from (parameter name, value) to the set of (class id, key)
+	of all table rows with this value, where key is the table index value
+	of the row, the row and column index values for 2D tables, or None for
+	literal parameters. It is built per collection.
+	"""
+	def __init__(self):
+		self.postings = {}
+		#collection id to stamp and the entries it contributed
+		self.collections = {}
+
+	def add_collection(self,coll,stamp=None):
+		if coll.id in self.collections:
+			self.remove_collection(coll.id)
+		entries = []
+		for cl in coll.classes_by_ids():
+			for value, key in _class_entries(cl):
+				entry = (cl.id,key)
+				self.postings.setdefault(value,set()).add(entry)
+				entries.append((value,entry))
+		self.collections[coll.id] = (stamp,entries)
+
+	def remove_collection(self,collid):
+		for value, entry in self.collections.pop(collid)[1]:
+			postings = self.postings.get(value)
+			if postings is None:
+				continue
+			postings.discard(entry)
+			if len(postings) == 0:
+				del self.postings[value]
+
+	def update(self,repo):
+		"""
+		Brings the index up to date with a BOLTSRepository, only collections
+		that changed are indexed again. Returns the ids of these collections.
+		"""
+		current = dict((coll.id,coll) for coll in repo.collections)
+		for collid in self.collections.keys():
+			if not collid in current:
+				self.remove_collection(collid)
+		updated = []
+		for collid, coll in current.iteritems():
+			stamp = repo.get_stamp(collid)
+			if collid in self.collections and self.collections[collid][0] == stamp:
+				continue
+			self.add_collection(coll,stamp)
+			updated.append(collid)
+		return updated
+
+	def lookup(self,pname,value):
+		"Returns the set of (class id, key) with the given parameter value"
+		return set(self.postings.get((pname,normalize_value(value)),()))
+
+	def query(self,constraints):
+		"""
+		Returns the set of (class id, key) that satisfy all constraints, a
+		dict of parameter names and values
+		"""
+		sets = [self.postings.get((pname,normalize_value(value)),set())
+			for pname, value in constraints.iteritems()]
+		if len(sets) == 0:
+			return set()
+		#intersecting in order of size keeps intermediate results small
+		sets.sort(key=len)
+		#class id to matching keys
+		res = {}
+		for classid, key in sets[0]:
+			res.setdefault(classid,set()).add(key)
+		for entries in sets[1:]:
+			keys = {}
+			for classid, key in entries:
+				if classid in res:
+					keys.setdefault(classid,set()).add(key)
+			for classid in res.keys():
+				if classid in keys:
+					res[classid] = _matches(res[classid],keys[classid])
+				if not classid in keys or len(res[classid]) == 0:
+					del res[classid]
+			if len(res) == 0:
+				break
+		return set((classid,key) for classid in res for key in res[classid])
+
+	def query_classes(self,constraints):
+		"""
+		Returns the set of class ids that have each of the constraints
+		satisfied by some table row or literal, not necessarily the same
+		"""
+		res = None
+		for pname, value in constraints.iteritems():
+			classids = set(entry[0] for entry in self.lookup(pname,value))
+			if res is None:
+				res = classids
+			else:
+				res &= classids
+			if len(res) == 0:
+				break
+		if res is None:
+			return set()
+		return res
+
+	def save(self,filename):
+		tmpname = "%s.%d.tmp" % (filename,os.getpid())
+		with open(tmpname,"wb") as fid:
+			pickle.dump((CACHE_VERSION,self.collections),fid,pickle.HIGHEST_PROTOCOL)
+		os.rename(tmpname,filename)
+
+def load_index(filename):
+	"""
+	Loads a ValueIndex stored with save, returns an empty index if the file
+	is missing or unusable. Use update to bring it up to date.
+	"""
+	index = ValueIndex()
+	if not exists(filename):
+		return index
+	try:
+		with open(filename,"rb") as fid:
+			version, collections = pickle.load(fid)
+	except Exception:
+		return index
+	if version != CACHE_VERSION:
+		return index
+	#the postings are rebuilt from the entries of the collections
+	for collid, (stamp, entries) in collections.iteritems():
+		for value, entry in entries:
+			index.postings.setdefault(value,set()).add(entry)
+		index.collections[collid] = (stamp,entries)
+	return index